@@ -0,0 +1,82 @@
+# micro-benchmark of formatDataTopotrigger: time and memory peak of the current version
+# compared to the previous one (pad/fill/stack per collection, then concatenate)
+#
+# usage: python benchmarks/bench_formatDataTopotrigger.py [nEvents ...]
+
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import awkward as ak
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from preprocessing import formatDataTopotrigger
+
+
+def syntheticData(nEvents, seed = 42):
+    # random L1-like objects: a variable number of jets, muons and egammas, and four energy sums per event
+    rng = np.random.default_rng(seed)
+    
+    dataDict = {}
+    for collection, maxN in [("jets", 12), ("muons", 4), ("egammas", 6)]:
+        counts = rng.integers(0, maxN + 1, nEvents)
+        nObjects = counts.sum()
+        dataDict[collection] = ak.zip({
+            "pt": ak.unflatten(rng.exponential(20, nObjects).astype(np.float32), counts),
+            "eta": ak.unflatten(rng.normal(0, 2, nObjects).astype(np.float32), counts),
+            "phi": ak.unflatten(rng.uniform(-np.pi, np.pi, nObjects).astype(np.float32), counts),
+        })
+    
+    counts = np.full(nEvents, 4)
+    dataDict["energysums"] = ak.zip({
+        "pt": ak.unflatten(rng.exponential(30, 4 * nEvents).astype(np.float32), counts),
+        "phi": ak.unflatten(rng.uniform(-np.pi, np.pi, 4 * nEvents).astype(np.float32), counts),
+        "Type": ak.unflatten(np.tile(np.array([0, 1, 2, 3], dtype=np.int16), nEvents), counts),
+    })
+    
+    return dataDict
+
+
+# the previous implementation, kept here as reference
+def legacy_awkward_to_numpy(ak_array, maxN):
+    selected_arr = ak.fill_none( ak.pad_none( ak_array, maxN, clip=True, axis=-1), {"pt":0, "eta":0, "phi":0})
+    np_arr = np.stack( (selected_arr.pt.to_numpy(), selected_arr.eta.to_numpy(), selected_arr.phi.to_numpy()), axis=2)
+    return np_arr.reshape(np_arr.shape[0], np_arr.shape[1] * np_arr.shape[2])
+
+def legacyFormatDataTopotrigger(infoDict, data):
+    energysums = data["energysums"]
+    np_MET = np.asarray( ak.to_numpy( energysums[energysums.Type == 2].pt).flatten() ).reshape( (len(energysums), 1) )
+    np_MET_phi = np.asarray( ak.to_numpy(energysums[energysums.Type == 2].phi).flatten() ).reshape( (len(energysums), 1) )
+    np_jets = legacy_awkward_to_numpy(data["jets"], infoDict["nJets"])
+    np_muons = legacy_awkward_to_numpy(data["muons"], infoDict["nMuons"])
+    np_egammas = legacy_awkward_to_numpy(data["egammas"], infoDict["nEgammas"])
+    return np.concatenate( (np_MET, np_MET_phi, np_jets, np_muons, np_egammas), axis=1 )
+
+
+def measure(function, *args):
+    # returns the output, the wall time in s and the memory peak in MB (above the memory in use before)
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = function(*args)
+    wall_time = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return output, wall_time, peak / 1e6
+
+
+if __name__ == "__main__":
+    
+    event_counts = [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]
+    infoDict = {"nJets": 10, "nMuons": 4, "nEgammas": 4}
+    
+    print("%10s  %-8s  %10s  %12s  %12s" % ("nEvents", "version", "time [s]", "peak [MB]", "output [MB]"))
+    for nEvents in event_counts:
+        data = syntheticData(nEvents)
+        
+        x_legacy, time_legacy, peak_legacy = measure(legacyFormatDataTopotrigger, infoDict, data)
+        x_current, time_current, peak_current = measure(formatDataTopotrigger, infoDict, data)
+        assert np.array_equal(x_legacy.astype(np.float32), x_current)
+        
+        print("%10i  %-8s  %10.3f  %12.1f  %12.1f" % (nEvents, "legacy", time_legacy, peak_legacy, x_legacy.nbytes / 1e6))
+        print("%10i  %-8s  %10.3f  %12.1f  %12.1f" % (nEvents, "current", time_current, peak_current, x_current.nbytes / 1e6))
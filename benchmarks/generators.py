@@ -0,0 +1,161 @@
+# generators for synthetic inputs, so that every stage can be benchmarked without our datasets:
+# - writeL1Ntuples: L1 ntuples with an event tree (l1UpgradeEmuTree/L1UpgradeTree) and a uGT tree (l1uGTTree/L1uGTTree)
+# - writeAnomalyh5: anomaly team style h5 files (background or signal)
+# - writeDenseModel: tiny dense topo trigger networks or autoencoders, stored in the format of our model dirs
+#
+# the objects are random, but the formats (branch names, types, multiplicities) follow the real files
+#
+# usage: python benchmarks/generators.py <output dir> [nEvents]
+
+import os
+import sys
+import pickle
+import numpy as np
+import awkward as ak
+import uproot
+import h5py
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from loadData import loadPrescaleTable
+
+default_prescale_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "Prescale_2022_v0_1_1.csv")
+
+
+def randomObjects(rng, nEvents, maxN, ptScale = 20):
+    # a variable number of objects per event (pt ordered, as in the L1 ntuples)
+    # returns the counts and the flat pt, eta and phi arrays
+    counts = rng.integers(0, maxN + 1, nEvents)
+    nObjects = counts.sum()
+    pt = rng.exponential(ptScale, nObjects).astype(np.float32)
+
+    # sorting the pts within every event in descending order
+    event_index = np.repeat(np.arange(nEvents), counts)
+    pt = pt[np.lexsort((-pt, event_index))]
+
+    eta = rng.normal(0, 2, nObjects).astype(np.float32)
+    phi = rng.uniform(-np.pi, np.pi, nObjects).astype(np.float32)
+    return counts, pt, eta, phi
+
+
+def writeL1Ntuples(output_dir, nEvents, nFiles = 1, prescale_file_name = default_prescale_file, seedRate = 0.01, seed = 1):
+    # writes nFiles L1 ntuples with nEvents events in total to output_dir/L1Ntuple_X.root
+    # the uGT tree only contains the decision branch: uproot can not write TTree aliases, so these files have to be
+    # read with bitIndexFromPrescale = True (the bit index of the prescale file is used). The translation of the
+    # aliases in real L1 ntuples (loadData.getBitPositions) is therefore not covered by the benchmarks
+    # seedRate: the probability of every seed to fire in an event
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok = True)
+
+    nMenuBits = max(loadPrescaleTable(prescale_file_name).values(), default = 0) + 1
+    nMenuBits = max(512, nMenuBits)
+
+    filepaths = []
+    for iFile, nFileEvents in enumerate(np.diff(np.linspace(0, nEvents, nFiles + 1).astype(int))):
+
+        branches = {}
+        for prefix, maxN in [("muon", 4), ("eg", 6), ("jet", 12)]:
+            counts, pt, eta, phi = randomObjects(rng, nFileEvents, maxN)
+            branches[prefix + "Et"] = ak.unflatten(pt, counts)
+            branches[prefix + "Eta"] = ak.unflatten(eta, counts)
+            branches[prefix + "Phi"] = ak.unflatten(phi, counts)
+
+        # energy sums: one of each type per event (0: total Et, 1: HT, 2: MET, 3: MHT)
+        counts = np.full(nFileEvents, 4)
+        branches["sumType"] = ak.unflatten(np.tile(np.arange(4, dtype=np.int16), nFileEvents), counts)
+        branches["sumEt"] = ak.unflatten(rng.exponential(30, 4 * nFileEvents).astype(np.float32), counts)
+        branches["sumPhi"] = ak.unflatten(rng.uniform(-np.pi, np.pi, 4 * nFileEvents).astype(np.float32), counts)
+
+        filepath = os.path.join(output_dir, "L1Ntuple_" + str(iFile) + ".root")
+        with uproot.recreate(filepath) as f:
+            f["l1UpgradeEmuTree/L1UpgradeTree"] = branches
+            f.mktree("l1uGTTree/L1uGTTree", {"L1uGT/m_algoDecisionFinal": ("bool", (nMenuBits,))})
+            f["l1uGTTree/L1uGTTree"].extend({"L1uGT/m_algoDecisionFinal": rng.random((nFileEvents, nMenuBits)) < seedRate})
+        filepaths.append(filepath)
+
+    return filepaths
+
+
+def randomCube(rng, nEvents):
+    # a (N,19,3) anomaly team data cube: MET (pt, 0, phi), 4 egammas, 4 muons, 10 jets
+    # empty objects are zero, and only at the end of each collection
+    cube = np.zeros( (nEvents, 19, 3), dtype=np.float32 )
+    cube[:,0,0] = rng.exponential(30, nEvents)
+    cube[:,0,2] = rng.uniform(-np.pi, np.pi, nEvents)
+    for rows, maxN in [(slice(1,5), 4), (slice(5,9), 4), (slice(9,19), 10)]:
+        counts = rng.integers(0, maxN + 1, nEvents)
+        objects = np.stack( (-np.sort(-rng.exponential(20, (nEvents, maxN)), axis=1),
+                             rng.normal(0, 2, (nEvents, maxN)),
+                             rng.uniform(-np.pi, np.pi, (nEvents, maxN))), axis=2 )
+        objects[np.arange(maxN)[None,:] >= counts[:,None]] = 0
+        cube[:,rows,:] = objects
+    return cube
+
+def writeAnomalyh5(filename, nEvents, processes = None, seeds = ("L1_SingleMu22", "L1_DoubleEG_LooseIso25_LooseIso12_er1p5"), chunked = False, seed = 2):
+    # writes an anomaly team h5 file
+    # - processes = None: background file (full_data_cyl, L1bit, one dataset per seed)
+    # - processes = [...]: signal file (<process>, <process>_l1bit, <process>_<seed>)
+    # chunked = True stores the cubes chunked and compressed (these can not be memory-mapped)
+    rng = np.random.default_rng(seed)
+    dataset_options = {"chunks": (min(nEvents, 10000), 19, 3), "compression": "gzip"} if chunked else {}
+
+    with h5py.File(filename, "w") as f:
+        if processes is None:
+            f.create_dataset("full_data_cyl", data = randomCube(rng, nEvents), **dataset_options)
+            f["L1bit"] = rng.random(nEvents) < 0.3
+            for name in seeds: f[name] = rng.random(nEvents) < 0.01
+        else:
+            for process in processes:
+                f.create_dataset(process, data = randomCube(rng, nEvents), **dataset_options)
+                f[process + "_l1bit"] = rng.random(nEvents) < 0.3
+                for name in seeds: f[process + "_" + name] = rng.random(nEvents) < 0.01
+
+    return filename
+
+
+def writeDenseModel(model_dir, modelType = "topo", nJets = 10, nMuons = 4, nEgammas = 4, folds = 2, hidden = (32, 16), seed = 3):
+    # writes a model dir with untrained dense networks (model_foldX.h5), StandardScalers (scaler_foldX.pkl)
+    # and network_info.pkl
+    # - modelType = "topo": a classifier with a single sigmoid output
+    # - modelType = "anomaly": an autoencoder of the 57 anomaly detection inputs
+
+    # importing keras only here, as it takes a few seconds
+    import keras
+    from sklearn.preprocessing import StandardScaler
+
+    rng = np.random.default_rng(seed)
+    keras.utils.set_random_seed(seed)
+    os.makedirs(model_dir, exist_ok = True)
+
+    infoDict = {"type": modelType, "folds": folds, "nJets": nJets, "nMuons": nMuons, "nEgammas": nEgammas}
+    with open(os.path.join(model_dir, "network_info.pkl"), "wb") as f: pickle.dump(infoDict, f)
+
+    nInputs = 2 + 3 * (nJets + nMuons + nEgammas) if modelType == "topo" else 3 * (1 + nJets + nMuons + nEgammas)
+
+    for fold in range(folds):
+        scaler = StandardScaler().fit( rng.exponential(20, (1000, nInputs)) )
+        with open(os.path.join(model_dir, "scaler_fold" + str(fold) + ".pkl"), "wb") as f: pickle.dump(scaler, f)
+
+        layers = [keras.Input((nInputs,))]
+        if modelType == "topo":
+            layers += [keras.layers.Dense(n, activation = "relu") for n in hidden]
+            layers += [keras.layers.Dense(1, activation = "sigmoid")]
+        else:
+            layers += [keras.layers.Dense(n, activation = "relu") for n in hidden]
+            layers += [keras.layers.Dense(n, activation = "relu") for n in reversed(hidden[:-1])]
+            layers += [keras.layers.Dense(nInputs)]
+
+        keras.Sequential(layers).save(os.path.join(model_dir, "model_fold" + str(fold) + ".h5"))
+
+    return model_dir
+
+
+if __name__ == "__main__":
+
+    output_dir = sys.argv[1]
+    nEvents = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    writeL1Ntuples(os.path.join(output_dir, "ntuples"), nEvents, nFiles = 2)
+    writeAnomalyh5(os.path.join(output_dir, "background.h5"), nEvents)
+    writeAnomalyh5(os.path.join(output_dir, "signal.h5"), nEvents, processes = ["haa4b", "hToTauTau"])
+    writeDenseModel(os.path.join(output_dir, "topo"))
+    writeDenseModel(os.path.join(output_dir, "anomaly"), modelType = "anomaly")
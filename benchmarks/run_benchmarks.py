@@ -0,0 +1,276 @@
+# benchmarks of every stage (reading, preprocessing, inference, trigger definition, histogramming)
+# on synthetic inputs from generators.py, at several event counts
+#
+# for every benchmark, the wall time (best of --repeat runs) and the memory peak (one extra run with
+# tracemalloc, as tracing slows down the code) are measured. The results can be stored as json (--save) and
+# compared to a stored baseline (--compare), e.g. the one in benchmarks/baseline.json. Times depend on the
+# machine, so a new baseline should be stored before comparing changes on a different one.
+#
+# usage:
+# python benchmarks/run_benchmarks.py --events 10000 100000 --compare benchmarks/baseline.json
+# python benchmarks/run_benchmarks.py --events 10000 100000 --save benchmarks/baseline.json
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from importlib.util import find_spec
+import numpy as np
+import awkward as ak
+import uproot
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from loadData import readFromL1Ntuple, iterateL1Ntuple, readFromAnomalyBackgroundh5, LazyAnomalyh5
+from preprocessing import awkward_to_numpy, formatDataTopotrigger, formatDataAnomaly, prepareData
+from inference import runInference, runBatchedInference, runBatchedReconstructionLoss, defineTriggerFromThreshold, scanThresholds, OverlapCounter
+from modelBundle import loadModelBundle
+from plotting import HistAccumulator, SculptingAccumulator
+from generators import writeL1Ntuples, writeAnomalyh5, writeDenseModel, default_prescale_file
+
+
+class Inputs:
+    # the synthetic inputs of one event count, generated on first use and kept in workdir,
+    # so that they are only written once (also across runs)
+
+    def __init__(self, workdir, nEvents):
+        self.workdir = workdir
+        self.nEvents = nEvents
+        self.prescale_file = default_prescale_file
+        self.cache = {}
+
+    def cached(self, key, function):
+        if key not in self.cache: self.cache[key] = function()
+        return self.cache[key]
+
+    @property
+    def ntuple_dir(self):
+        path = os.path.join(self.workdir, "ntuples_" + str(self.nEvents))
+        if not os.path.exists(path): writeL1Ntuples(path, self.nEvents, nFiles = 2)
+        return path
+
+    @property
+    def background_file(self):
+        path = os.path.join(self.workdir, "background_" + str(self.nEvents) + ".h5")
+        if not os.path.exists(path): writeAnomalyh5(path, self.nEvents)
+        return path
+
+    def modelDir(self, modelType):
+        # the models do not depend on the event count
+        path = os.path.join(self.workdir, "model_" + modelType)
+        if not os.path.exists(os.path.join(path, "network_info.pkl")): writeDenseModel(path, modelType = modelType)
+        return path
+
+    # outputs of the previous stages, as inputs for the later ones
+    def l1Ntuple(self):
+        return self.cached("l1Ntuple", lambda: readFromL1Ntuple(self.ntuple_dir, self.prescale_file, bitIndexFromPrescale = True))
+
+    def background(self):
+        return self.cached("background", lambda: readFromAnomalyBackgroundh5(self.background_file))
+
+    def topoInputs(self):
+        return self.cached("topoInputs", lambda: prepareData(self.modelDir("topo"), self.l1Ntuple()[1], scale = False))
+
+    def anomalyInputs(self):
+        return self.cached("anomalyInputs", lambda: prepareData(self.modelDir("anomaly"), self.background()[1], scale = False))
+
+    def scores(self):
+        return self.cached("scores", lambda: np.random.default_rng(4).random(self.nEvents).astype(np.float32))
+
+
+# the benchmarks: name -> setup function, which prepares everything that is not measured
+# and returns the function to measure
+benchmarks = {}
+
+def benchmark(name, needs = None):
+    # needs: optional module that has to be importable (e.g. keras), otherwise the benchmark is skipped
+    def register(setup):
+        benchmarks[name] = (setup, needs)
+        return setup
+    return register
+
+
+@benchmark("readFromL1Ntuple")
+def setupReadFromL1Ntuple(inputs):
+    ntuple_dir = inputs.ntuple_dir
+    return lambda: readFromL1Ntuple(ntuple_dir, inputs.prescale_file, bitIndexFromPrescale = True)
+
+@benchmark("iterateL1Ntuple")
+def setupIterateL1Ntuple(inputs):
+    ntuple_dir = inputs.ntuple_dir
+    return lambda: sum(info["nEvents"] for info, data, bits in iterateL1Ntuple(ntuple_dir, inputs.prescale_file, step_size = 50000, bitIndexFromPrescale = True))
+
+@benchmark("readFromAnomalyBackgroundh5")
+def setupReadFromAnomalyBackgroundh5(inputs):
+    background_file = inputs.background_file
+    return lambda: readFromAnomalyBackgroundh5(background_file)
+
+@benchmark("LazyAnomalyh5.iterate")
+def setupLazyAnomalyh5(inputs):
+    background_file = inputs.background_file
+    def run():
+        # formating every chunk, so that the events are actually read from the (memory-mapped) file
+        with LazyAnomalyh5(background_file) as reader:
+            return sum(len(formatDataTopotrigger({"nJets": 10, "nMuons": 4, "nEgammas": 4}, data)) for info, data, bits in reader.iterate(step_size = 50000))
+    return run
+
+@benchmark("awkward_to_numpy")
+def setupAwkwardToNumpy(inputs):
+    jets = inputs.l1Ntuple()[1]["jets"]
+    return lambda: awkward_to_numpy(jets, 10)
+
+@benchmark("formatDataTopotrigger")
+def setupFormatDataTopotrigger(inputs):
+    data = inputs.l1Ntuple()[1]
+    return lambda: formatDataTopotrigger({"nJets": 10, "nMuons": 4, "nEgammas": 4}, data)
+
+@benchmark("formatDataTopotrigger (dense)")
+def setupFormatDataTopotriggerDense(inputs):
+    data = inputs.background()[1]
+    return lambda: formatDataTopotrigger({"nJets": 10, "nMuons": 4, "nEgammas": 4}, data)
+
+@benchmark("formatDataAnomaly")
+def setupFormatDataAnomaly(inputs):
+    data = inputs.l1Ntuple()[1]
+    return lambda: formatDataAnomaly({}, data)
+
+@benchmark("runInference (keras)", needs = "keras")
+def setupRunInference(inputs):
+    bundle = loadModelBundle(inputs.modelDir("topo"))
+    bundle.getModels()
+    x = bundle.scalers[0].transform(inputs.topoInputs())
+    return lambda: runInference(bundle, x, batch_size = 10000)
+
+@benchmark("runBatchedInference (keras)", needs = "keras")
+def setupRunBatchedInferenceKeras(inputs):
+    bundle = loadModelBundle(inputs.modelDir("topo"))
+    bundle.getModels()
+    x = inputs.topoInputs()
+    return lambda: runBatchedInference(bundle, x)
+
+@benchmark("runBatchedInference (numpy)")
+def setupRunBatchedInferenceNumpy(inputs):
+    bundle = loadModelBundle(inputs.modelDir("topo"), backend = "numpy")
+    bundle.getModels()
+    x = inputs.topoInputs()
+    return lambda: runBatchedInference(bundle, x)
+
+@benchmark("runBatchedReconstructionLoss (numpy)")
+def setupRunBatchedReconstructionLoss(inputs):
+    bundle = loadModelBundle(inputs.modelDir("anomaly"), backend = "numpy")
+    bundle.getModels()
+    x = inputs.anomalyInputs()
+    return lambda: runBatchedReconstructionLoss(bundle, x)
+
+@benchmark("defineTriggerFromThreshold")
+def setupDefineTriggerFromThreshold(inputs):
+    scores = inputs.scores()
+    return lambda: [defineTriggerFromThreshold(scores, threshold) for threshold in np.linspace(0.9, 0.999, 10)]
+
+@benchmark("scanThresholds")
+def setupScanThresholds(inputs):
+    scores = inputs.scores()
+    return lambda: scanThresholds(scores, thresholds = np.linspace(0, 1, 1000), y_signal = scores[::2])
+
+@benchmark("OverlapCounter.fill")
+def setupOverlapCounter(inputs):
+    scores = inputs.scores()
+    bits = inputs.l1Ntuple()[2]
+    return lambda: OverlapCounter(np.linspace(0.9, 0.999, 10)).fill(scores, bits)
+
+@benchmark("HistAccumulator.fill")
+def setupHistAccumulator(inputs):
+    pts = inputs.l1Ntuple()[1]["jets"].pt
+    return lambda: HistAccumulator(100, (0, 200)).fill(ak.to_numpy(ak.flatten(pts)))
+
+@benchmark("SculptingAccumulator.fill")
+def setupSculptingAccumulator(inputs):
+    pts = inputs.l1Ntuple()[1]["jets"].pt
+    triggerBit = inputs.scores() > 0.9
+    return lambda: SculptingAccumulator(100, (0, 200), index = 0).fill(pts, triggerBit)
+
+
+def measure(function, repeat = 3):
+    # returns the best wall time in s out of repeat runs, and the memory peak in MB of one traced run
+    wall_time = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        wall_time = min(wall_time, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return wall_time, peak / 1e6
+
+
+def runBenchmarks(event_counts, workdir, names = None, repeat = 3, verbosity = 1):
+    # runs all benchmarks (or the ones in names) for every event count, returns a list of result dicts
+    results = []
+    for nEvents in event_counts:
+        inputs = Inputs(workdir, nEvents)
+        for name, (setup, needs) in benchmarks.items():
+            if names and name not in names: continue
+            if needs and find_spec(needs) is None:
+                if(verbosity > 0): print("Skipping " + name + ", " + needs + " is not available.")
+                continue
+
+            wall_time, peak = measure(setup(inputs), repeat = repeat)
+            results.append({"benchmark": name, "nEvents": nEvents, "time": wall_time, "peak": peak})
+            if(verbosity > 0): print("%-40s  %10i  %10.4f  %12.1f" % (name, nEvents, wall_time, peak))
+    return results
+
+
+def environment():
+    return {"python": platform.python_version(), "platform": platform.platform(), "numpy": np.__version__,
+            "awkward": ak.__version__, "uproot": uproot.__version__}
+
+def compareToBaseline(results, baseline, tolerance = 1.5):
+    # prints the ratios to the baseline, returns the results that are slower than tolerance * baseline
+    baseline_times = {(result["benchmark"], result["nEvents"]):result for result in baseline["results"]}
+
+    regressions = []
+    print("%-40s  %10s  %10s  %10s  %8s  %10s" % ("benchmark", "nEvents", "time [s]", "base [s]", "ratio", "peak ratio"))
+    for result in results:
+        key = (result["benchmark"], result["nEvents"])
+        if key not in baseline_times: continue
+        reference = baseline_times[key]
+        ratio = result["time"] / reference["time"] if reference["time"] > 0 else float("inf")
+        peak_ratio = result["peak"] / reference["peak"] if reference["peak"] > 0 else float("inf")
+        flag = "  <-- slower" if ratio > tolerance else ""
+        print("%-40s  %10i  %10.4f  %10.4f  %8.2f  %10.2f%s" % (key + (result["time"], reference["time"], ratio, peak_ratio, flag)))
+        if ratio > tolerance: regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmarks of all stages on synthetic inputs.")
+    parser.add_argument("--events", type = int, nargs = "+", default = [10000, 100000])
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--only", nargs = "+", choices = list(benchmarks), help = "only run these benchmarks")
+    parser.add_argument("--workdir", default = os.path.join(tempfile.gettempdir(), "l1trigger_benchmarks"),
+                        help = "where the synthetic inputs are stored (and reused)")
+    parser.add_argument("--save", help = "store the results as json")
+    parser.add_argument("--compare", help = "compare to the results stored in this json file")
+    parser.add_argument("--tolerance", type = float, default = 1.5, help = "allowed slowdown w.r.t. the baseline")
+    args = parser.parse_args()
+
+    print("%-40s  %10s  %10s  %12s" % ("benchmark", "nEvents", "time [s]", "peak [MB]"))
+    results = runBenchmarks(args.events, args.workdir, names = args.only, repeat = args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as f: json.dump({"environment": environment(), "results": results}, f, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)
+        print()
+        regressions = compareToBaseline(results, baseline, tolerance = args.tolerance)
+        if regressions:
+            print("%i benchmark(s) slower than %.1f times the baseline." % (len(regressions), args.tolerance))
+            sys.exit(1)
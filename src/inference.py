@@ -1,28 +1,146 @@
-import keras
+import time
+import numpy as np
 import pandas as pd
+from modelBundle import ModelBundle, loadModel, getModelBundle
+import instrumentation
 
 # Functions to run the inference on the dataset
-def runInference(model_file, x, verbosity = 0):
+@instrumentation.instrument(events = len)
+def runInference(model_file, x, fold = 0, backend = "keras", batch_size = None, verbosity = 0):
     # Expected input:
-    # - path to the model file
+    # - path to the model file (or a ModelBundle, then the model of the given fold is used)
     # - everything from preparedata
+    # - backend: "keras", or "numpy" to evaluate the dense layers with numpy only (no tensorflow needed),
+    #   see modelBundle.py. For a ModelBundle, the backend of the bundle is used
     #
     # Expected output:
     # - output scores (numpy array)
     
-    if(verbosity > 0): print("Loading model from " + str(model_file) + "...")
-    model = keras.models.load_model(model_file)
+    # the models are cached, so they are only loaded from disk the first time
+    if isinstance(model_file, ModelBundle): model = model_file.getModel(fold)
+    else: model = loadModel(model_file, backend = backend, verbosity = verbosity)
 
     if(verbosity > 0): print("Starting inference...")
         
-    y_pred = model.predict(x)
+    if batch_size: y_pred = model.predict(x, batch_size = batch_size, verbose = 0)
+    else: y_pred = model.predict(x)
     
     return y_pred
 
 
+def evaluateBatch(model, scaler, x_batch, batchScore = None):
+    # the scores of one batch: scaling (if the fold has a scaler), the model and batchScore
+    if scaler is not None: x_batch = scaler.transform(x_batch)
+    y_batch = np.asarray( model.predict_on_batch(x_batch) )
+    if batchScore: y_batch = batchScore(x_batch, y_batch)
+    return y_batch
+
+@instrumentation.instrument(events = len)
+def runBatchedInference(model_dir, x, batch_size = 10000, foldMode = "ensemble", eventFolds = None, backend = "keras", batchScore = None, verbosity = 0):
+    # Inference engine for all folds of a model, that streams x through the models batch by batch,
+    # so that at most one batch of scaled inputs and activations is in memory at a time
+    #
+    # Expected input:
+    # - model dir or ModelBundle (for a model dir, the models are evaluated with the given backend)
+    # - x: the *unscaled* NN inputs, i.e. prepareData(..., scale = False). The scaler of each fold is applied per batch
+    # - foldMode:
+    #   - "ensemble": the mean score of all folds
+    #   - "byEvent": every event is only evaluated by one fold, given by eventFolds (default: event index modulo the number of folds)
+    #   - an integer: only evaluate this fold
+    # - batchScore: optional function (x_batch, y_batch) -> scores, applied to the (scaled) inputs and the model
+    #   outputs of every batch, so that only its result is kept (e.g. the reconstruction loss of autoencoders)
+    #
+    # Expected output:
+    # - output scores (numpy array, same shape as from runInference, or as returned by batchScore)
+    
+    bundle = getModelBundle(model_dir, backend = backend, verbosity = verbosity)
+    nEvents = len(x)
+    
+    if foldMode == "ensemble": folds = list(range(bundle.folds))
+    elif foldMode == "byEvent":
+        folds = list(range(bundle.folds))
+        if eventFolds is None: eventFolds = np.arange(nEvents) % bundle.folds
+    elif isinstance(foldMode, int): folds = [foldMode]
+    else: raise Exception("Fold mode " + str(foldMode) + " not recognized.")
+    
+    if(verbosity > 0): print("Starting batched inference on %i events with batch size %i and folds %s..." % (nEvents, batch_size, folds))
+    start_time = time.perf_counter()
+    
+    # the score array is allocated once we know the output shape of the model
+    y_pred = None
+    for fold in folds:
+        model = bundle.getModel(fold)
+        # there is a scaler for every fold, None is only allowed for anomaly detection models (see ModelBundle)
+        scaler = bundle.scalers[fold]
+        
+        for start in range(0, nEvents, batch_size):
+            stop = min(start + batch_size, nEvents)
+            
+            if foldMode == "byEvent":
+                events = start + np.nonzero(eventFolds[start:stop] == fold)[0]
+                if len(events) == 0: continue
+                x_batch = x[events]
+            else:
+                events = slice(start, stop)
+                x_batch = x[start:stop]
+            
+            y_batch = evaluateBatch(model, scaler, x_batch, batchScore)
+            
+            if y_pred is None: y_pred = np.zeros( (nEvents,) + y_batch.shape[1:], dtype=y_batch.dtype )
+            
+            if foldMode == "ensemble": y_pred[events] += y_batch / len(folds)
+            else: y_pred[events] = y_batch
+    
+    # without any events, the output shape is taken from a single dummy event
+    if y_pred is None:
+        x_dummy = np.zeros( (1,) + np.shape(x)[1:], dtype=np.asarray(x).dtype )
+        y_batch = evaluateBatch(bundle.getModel(folds[0]), bundle.scalers[folds[0]], x_dummy, batchScore)
+        y_pred = np.zeros( (0,) + y_batch.shape[1:], dtype=y_batch.dtype )
+    
+    elapsed = time.perf_counter() - start_time
+    if(verbosity > 0): print("Processed %i events with %i fold(s) in %.2f s (%.0f events/s)." % (nEvents, len(folds), elapsed, nEvents / elapsed if elapsed > 0 else 0))
+    
+    return y_pred
+
+
+# per-event reconstruction losses of the (flattened) inputs and the model outputs
+reconstruction_losses = {
+    "mse": lambda x, y: np.mean( np.square(np.asarray(x, dtype=y.dtype) - y.reshape(len(y), -1)), axis=1 ),
+    "mae": lambda x, y: np.mean( np.abs(np.asarray(x, dtype=y.dtype) - y.reshape(len(y), -1)), axis=1 ),
+}
+
+def runBatchedReconstructionLoss(model_dir, x, batch_size = 10000, foldMode = "ensemble", eventFolds = None, loss = None, backend = "keras", verbosity = 0):
+    # Scores for autoencoders: the reconstruction loss per event, computed batch by batch with runBatchedInference.
+    # Only the loss vector is kept, never the full reconstructions, so the memory needed is one batch plus one
+    # float per event.
+    #
+    # Expected input:
+    # - model dir or ModelBundle, x: the unscaled inputs (prepareData(..., scale = False)), see runBatchedInference
+    # - loss: "mse" or "mae" (default: the "loss" in the infoDict of the model, or "mse")
+    #
+    # Expected output:
+    # - the loss per event (numpy array of shape (N,)), larger is more anomalous
+    
+    bundle = getModelBundle(model_dir, backend = backend, verbosity = verbosity)
+    if loss is None: loss = bundle.infoDict.get("loss", "mse")
+    if loss not in reconstruction_losses: raise Exception("Loss " + str(loss) + " not recognized.")
+    
+    return runBatchedInference(bundle, x, batch_size = batch_size, foldMode = foldMode, eventFolds = eventFolds,
+                               batchScore = reconstruction_losses[loss], verbosity = verbosity)
+
+def runBatchedScores(model_dir, x, batch_size = 10000, foldMode = "ensemble", eventFolds = None, backend = "keras", verbosity = 0):
+    # the trigger score of any model type: the reconstruction loss for anomaly detection models,
+    # the network output for everything else
+    bundle = getModelBundle(model_dir, backend = backend, verbosity = verbosity)
+    if bundle.infoDict["type"] == "anomaly":
+        return runBatchedReconstructionLoss(bundle, x, batch_size = batch_size, foldMode = foldMode, eventFolds = eventFolds, verbosity = verbosity)
+    return runBatchedInference(bundle, x, batch_size = batch_size, foldMode = foldMode, eventFolds = eventFolds, verbosity = verbosity)
+
+
 # quick method to define a trigger from a certain threshold
 # this will return the "trigger bit" of this trigger as a dataframe
 # other ways to define a trigger from a y_pred can be defined
+@instrumentation.instrument(events = len)
 def defineTriggerFromThreshold(y_pred, threshold, label = None, mode = "min", verbosity = 0):
     
     if label: label = label + "_"
@@ -36,3 +154,217 @@ def defineTriggerFromThreshold(y_pred, threshold, label = None, mode = "min", ve
         return pd.DataFrame( y_pred < threshold, columns=[label + mode + "_" + str(threshold).replace(".", "p")] )
     else:
         raise Exception("Mode " + mode + " not recognized.")
+
+
+# threshold scans: instead of calling defineTriggerFromThreshold for every threshold, the scores are
+# sorted once and the number of passing events for any threshold is found with a binary search.
+# the modes are the same as in defineTriggerFromThreshold ("min": score > threshold, "max": score < threshold)
+
+def countPassing(sorted_pred, thresholds, mode = "min"):
+    # number of events passing each of the thresholds, for scores that are sorted already
+    if mode == "min": return len(sorted_pred) - np.searchsorted(sorted_pred, thresholds, side = "right")
+    elif mode == "max": return np.searchsorted(sorted_pred, thresholds, side = "left")
+    else: raise Exception("Mode " + mode + " not recognized.")
+
+def getTotalRate(totalRate = None):
+    # the rate corresponding to all events, in kHz. By default the total minimum bias rate
+    if totalRate is not None: return totalRate
+    
+    # importing here, so that the plotting style is only loaded if needed
+    from plotting import totalMinBiasRate
+    return totalMinBiasRate()
+
+def thresholdForRate(y_pred, targetRates, mode = "min", totalRate = None, sorted_pred = None):
+    # the inverse of the threshold scan: the loosest threshold(s) for which the rate does not exceed the target rate(s) in kHz
+    # y_pred has to be a zero bias / minimum bias sample for this to make sense
+    if sorted_pred is None: sorted_pred = np.sort( np.asarray(y_pred).ravel() )
+    nEvents = len(sorted_pred)
+    
+    # maximum number of events that are allowed to pass
+    nAllowed = np.floor( np.asarray(targetRates, dtype=float) / getTotalRate(totalRate) * nEvents ).astype(np.int64)
+    nAllowed = np.clip(nAllowed, 0, nEvents)
+    
+    if mode == "min":
+        # score > sorted_pred[nEvents - nAllowed - 1] is true for at most nAllowed events
+        thresholds = sorted_pred[np.clip(nEvents - nAllowed - 1, 0, nEvents - 1)]
+        return np.where(nAllowed >= nEvents, np.nextafter(sorted_pred[0], -np.inf), thresholds)
+    elif mode == "max":
+        # score < sorted_pred[nAllowed] is true for at most nAllowed events
+        thresholds = sorted_pred[np.clip(nAllowed, 0, nEvents - 1)]
+        return np.where(nAllowed >= nEvents, np.nextafter(sorted_pred[-1], np.inf), thresholds)
+    else:
+        raise Exception("Mode " + mode + " not recognized.")
+
+@instrumentation.instrument()
+def scanThresholds(y_pred, thresholds = None, targetRates = None, mode = "min", y_signal = None, totalRate = None, verbosity = 0):
+    # Expected input:
+    # - y_pred: scores on a zero bias / minimum bias sample, used for the rates
+    # - thresholds: an arbitrary grid of thresholds, or
+    # - targetRates: rates in kHz, the thresholds are then determined with thresholdForRate
+    # - y_signal: optional scores on a signal sample, used for the signal efficiencies
+    # - totalRate: the rate of all events in kHz, by default plotting.totalMinBiasRate()
+    #
+    # Expected output:
+    # - a dataframe with one row per threshold: threshold, nPass, rate (kHz) and (if y_signal is given) nPassSignal, efficiency
+    
+    sorted_pred = np.sort( np.asarray(y_pred).ravel() )
+    instrumentation.addEvents(len(sorted_pred))
+    
+    if thresholds is None and targetRates is None: raise Exception("Either thresholds or targetRates have to be given.")
+    if targetRates is not None: thresholds = thresholdForRate(None, targetRates, mode = mode, totalRate = totalRate, sorted_pred = sorted_pred)
+    thresholds = np.atleast_1d( np.asarray(thresholds) )
+    
+    if (verbosity > 0): print("Scanning %i thresholds on %i events..." % (len(thresholds), len(sorted_pred)))
+    
+    nPass = countPassing(sorted_pred, thresholds, mode = mode)
+    
+    scan = pd.DataFrame( {"threshold": thresholds, "nPass": nPass, "rate": nPass / max(len(sorted_pred), 1) * getTotalRate(totalRate)} )
+    if targetRates is not None: scan["targetRate"] = np.atleast_1d(targetRates)
+    
+    if y_signal is not None:
+        sorted_signal = np.sort( np.asarray(y_signal).ravel() )
+        scan["nPassSignal"] = countPassing(sorted_signal, thresholds, mode = mode)
+        scan["efficiency"] = scan["nPassSignal"] / max(len(sorted_signal), 1)
+    
+    return scan
+
+
+# rates of a NN trigger with respect to the existing L1 menu
+# OverlapCounter counts, for a whole grid of thresholds at once and chunk by chunk:
+# - the events passing the NN trigger (rate)
+# - the events passing the NN trigger, but not the total L1 bit (pure rate)
+# - the events passing the NN trigger and each of the L1 seeds (overlap)
+# - the events passing the NN trigger and only this one L1 seed (unique contribution of the seed,
+#   i.e. the part of the seed's rate that would be covered by the NN trigger if the seed was removed)
+#
+# usage:
+# counter = OverlapCounter(thresholds, mode = "min")
+# for chunk in ...:
+#     counter.fill(y_pred, bits)
+# counter.summary(), counter.overlapTable(), counter.uniqueTable()
+#
+# counters from different files / workers can be merged with +
+
+class OverlapCounter:
+    
+    def __init__(self, thresholds, seeds = None, mode = "min"):
+        if mode not in ["min", "max"]: raise Exception("Mode " + mode + " not recognized.")
+        self.mode = mode
+        
+        # the thresholds are ordered such that the passed ones are always the first ones:
+        # for "min", a score passes all thresholds below it, for "max" all thresholds above it
+        thresholds = np.atleast_1d( np.asarray(thresholds, dtype=float) )
+        self.thresholds = np.sort(thresholds) if mode == "min" else np.sort(thresholds)[::-1]
+        
+        self.seeds = list(seeds) if seeds is not None else None
+        self.nEvents = 0
+        self.nPass = np.zeros(len(self.thresholds), dtype=np.int64)
+        self.nPure = np.zeros(len(self.thresholds), dtype=np.int64)
+        self.nSeed = None
+        self.nOverlap = None
+        self.nUnique = None
+    
+    def nPassedThresholds(self, y_pred):
+        # the number of thresholds each event passes
+        y_pred = np.asarray(y_pred).ravel()
+        if self.mode == "min": return np.searchsorted(self.thresholds, y_pred, side = "left")
+        else: return np.searchsorted(-self.thresholds, -y_pred, side = "left")
+    
+    def countPerThreshold(self, nPassed, weights = None):
+        # per threshold j: sum of weights of all events passing it (nPassed > j)
+        # weights can be None (counting events) or a (nEvents, nSeeds) matrix
+        nThresholds = len(self.thresholds)
+        if weights is None:
+            histogram = np.bincount(nPassed, minlength = nThresholds + 1)
+        else:
+            # only events that pass at least the loosest threshold matter; sorting them by nPassed,
+            # so that the seed bits can be summed per value of nPassed in one go
+            events = np.nonzero(nPassed > 0)[0]
+            events = events[np.argsort(nPassed[events], kind = "stable")]
+            histogram = np.zeros( (nThresholds + 1, weights.shape[1]), dtype=np.int64 )
+            if len(events) > 0:
+                values, starts = np.unique(nPassed[events], return_index = True)
+                histogram[values] = np.add.reduceat(weights[events], starts, axis = 0, dtype = np.int64)
+        
+        # reverse cumulative sum: events with nPassed > j
+        return np.cumsum(histogram[::-1], axis = 0)[::-1][1:]
+    
+    @instrumentation.instrument("OverlapCounter.fill")
+    def fill(self, y_pred, bits, packed = False):
+        # bits: the L1 bits dataframe from the loaders ("total L1" and the seeds), or a boolean
+        # (nEvents, nSeeds) numpy matrix of the seeds; with packed = True a matrix from np.packbits(..., axis=1)
+        # the pure rate is defined w.r.t. the "total L1" column of the dataframe; for matrices (and dataframes
+        # without this column) the total L1 bit is the OR of the given seeds
+        instrumentation.addEvents(len(y_pred))
+        total_L1 = None
+        if isinstance(bits, pd.DataFrame):
+            seeds = [column for column in bits.columns if column != "total L1"]
+            bit_matrix = bits[seeds].to_numpy(dtype = bool)
+            if "total L1" in bits.columns: total_L1 = bits["total L1"].to_numpy(dtype = bool)
+        else:
+            seeds = self.seeds
+            bit_matrix = np.asarray(bits)
+            if packed: bit_matrix = np.unpackbits(bit_matrix, axis = 1, count = len(seeds) if seeds else None)
+            bit_matrix = bit_matrix.astype(bool, copy = False)
+        
+        if self.seeds is None: self.seeds = seeds
+        if seeds is not None and list(seeds) != self.seeds: raise Exception("The L1 seeds changed between chunks.")
+        if self.seeds is None: self.seeds = ["seed_" + str(i) for i in range(bit_matrix.shape[1])]
+        
+        if total_L1 is None: total_L1 = bit_matrix.any(axis = 1)
+        only_one = bit_matrix.sum(axis = 1) == 1
+        
+        nPassed = self.nPassedThresholds(y_pred)
+        if len(nPassed) != len(bit_matrix): raise Exception("Scores and L1 bits have different lengths.")
+        
+        if self.nOverlap is None:
+            self.nSeed = np.zeros(len(self.seeds), dtype=np.int64)
+            self.nOverlap = np.zeros( (len(self.thresholds), len(self.seeds)), dtype=np.int64 )
+            self.nUnique = np.zeros( (len(self.thresholds), len(self.seeds)), dtype=np.int64 )
+        
+        self.nEvents += len(nPassed)
+        self.nPass += self.countPerThreshold(nPassed)
+        self.nPure += self.countPerThreshold(nPassed[~total_L1])
+        self.nSeed += bit_matrix.sum(axis = 0)
+        self.nOverlap += self.countPerThreshold(nPassed, bit_matrix)
+        self.nUnique += self.countPerThreshold(np.where(only_one, nPassed, 0), bit_matrix)
+        
+        return self
+    
+    def __add__(self, other):
+        if not np.array_equal(self.thresholds, other.thresholds) or self.mode != other.mode: raise Exception("Cannot merge counters with different thresholds.")
+        if other.nOverlap is None: return self
+        if self.nOverlap is None: return other
+        if self.seeds != other.seeds: raise Exception("Cannot merge counters with different L1 seeds.")
+        
+        merged = OverlapCounter(self.thresholds, seeds = self.seeds, mode = self.mode)
+        merged.nEvents = self.nEvents + other.nEvents
+        for attribute in ["nPass", "nPure", "nSeed", "nOverlap", "nUnique"]:
+            setattr(merged, attribute, getattr(self, attribute) + getattr(other, attribute))
+        return merged
+    
+    def toRate(self, counts, totalRate = None):
+        return counts / max(self.nEvents, 1) * getTotalRate(totalRate)
+    
+    def summary(self, totalRate = None):
+        # rate and pure rate (in kHz) per threshold
+        return pd.DataFrame( {"threshold": self.thresholds, "nPass": self.nPass, "rate": self.toRate(self.nPass, totalRate),
+                              "nPure": self.nPure, "pureRate": self.toRate(self.nPure, totalRate)} )
+    
+    def overlapTable(self, totalRate = None):
+        # rate (in kHz) of events passing the NN trigger and the seed, thresholds x seeds
+        return pd.DataFrame( self.toRate(self.nOverlap, totalRate), index = pd.Index(self.thresholds, name = "threshold"), columns = self.seeds )
+    
+    def uniqueTable(self, totalRate = None):
+        # rate (in kHz) of events passing the NN trigger and only this seed, thresholds x seeds
+        return pd.DataFrame( self.toRate(self.nUnique, totalRate), index = pd.Index(self.thresholds, name = "threshold"), columns = self.seeds )
+    
+    def seedRates(self, totalRate = None):
+        # rate (in kHz) of each seed alone, for reference
+        return pd.Series( self.toRate(self.nSeed, totalRate), index = self.seeds )
+
+
+def computeOverlapRates(y_pred, bits, thresholds, mode = "min", totalRate = None):
+    # single pass version of OverlapCounter, returns the summary, overlap and unique tables
+    counter = OverlapCounter(thresholds, mode = mode).fill(y_pred, bits)
+    return counter.summary(totalRate), counter.overlapTable(totalRate), counter.uniqueTable(totalRate)
@@ -0,0 +1,219 @@
+import os
+import time
+import json
+import resource
+import threading
+import tracemalloc
+from functools import wraps
+import pandas as pd
+
+# Opt-in instrumentation of the stages in loadData, preprocessing, inference and plotting.
+# For every stage (and every chunk of the streaming readers), the wall time, the number of events,
+# the bytes read and the memory peak are recorded. This shows whether a job is limited by I/O,
+# by awkward or by the network inference, without an external profiler.
+#
+# usage:
+# import instrumentation
+# instrumentation.enable()                  # or enable(traceMemory = True), see below
+# ... run anything ...
+# print(instrumentation.summary())          # one line per stage
+# instrumentation.saveTrace("trace.json")   # all records, can be opened in chrome://tracing or perfetto
+#
+# As long as it is not enabled, every instrumented call only costs a check of a global flag.
+#
+# Memory: by default, the peak is the maximum resident memory of the process so far (cheap, but it never
+# decreases). With traceMemory = True, tracemalloc gives the peak of the allocations during each stage
+# instead, which slows everything down noticeably.
+# Notes:
+# - stages can be nested (e.g. readL1NtupleFile within readFromL1Ntuple), the times of the outer stages
+#   include the inner ones. Bytes and events added with addBytes/addEvents go to the innermost stage
+# - tracemalloc is process wide, so the traced peaks of stages in parallel threads include each other
+# - stages in worker processes (readFromL1Ntuple with nWorkers > 1) are not recorded, use useThreads
+
+enabled = False
+trace_memory = False
+records = []
+start_time = time.perf_counter()
+
+# the open stages of each thread
+local = threading.local()
+
+
+def enable(traceMemory = False, clear = True):
+    global enabled, trace_memory
+    if clear: reset()
+    trace_memory = traceMemory
+    if trace_memory and not tracemalloc.is_tracing(): tracemalloc.start()
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+    if trace_memory and tracemalloc.is_tracing(): tracemalloc.stop()
+
+def reset():
+    global start_time
+    records.clear()
+    start_time = time.perf_counter()
+
+
+def getStack():
+    if not hasattr(local, "stack"): local.stack = []
+    return local.stack
+
+def maxRSS():
+    # in MB, ru_maxrss is given in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class Stage:
+    # a context manager recording one stage
+    # nEvents and nBytes can be set (or added to) while the stage is running
+
+    def __init__(self, name, chunk = None, nEvents = None, nBytes = None):
+        self.name = name
+        self.chunk = chunk
+        self.nEvents = nEvents
+        self.nBytes = nBytes
+        self.child_peak = 0
+        self.discard = False
+
+    def __enter__(self):
+        stack = getStack()
+        if trace_memory:
+            # the peak since the start of the parent is saved in the parent, then the counter starts over
+            current, peak = tracemalloc.get_traced_memory()
+            if stack: stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        stop = time.perf_counter()
+        stack = getStack()
+        stack.pop()
+
+        if trace_memory:
+            peak = max(self.child_peak, tracemalloc.get_traced_memory()[1]) / 1e6
+            if stack: stack[-1].child_peak = max(stack[-1].child_peak, peak * 1e6)
+        else:
+            peak = maxRSS()
+
+        if self.discard: return
+        records.append({"stage": self.name, "chunk": self.chunk, "nEvents": self.nEvents, "nBytes": self.nBytes,
+                        "start": self.start - start_time, "time": stop - self.start, "peak": peak,
+                        "thread": threading.get_ident(), "depth": len(stack)})
+
+
+class NullStage:
+    # returned by stage() if the instrumentation is disabled, ignores everything
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+null_stage = NullStage()
+
+
+def stage(name, chunk = None, nEvents = None, nBytes = None):
+    # with instrumentation.stage("name") as stage:
+    #     ...
+    #     stage.nEvents = ...
+    if not enabled: return null_stage
+    return Stage(name, chunk = chunk, nEvents = nEvents, nBytes = nBytes)
+
+def addEvents(nEvents):
+    # adds events to the innermost running stage of this thread
+    if not enabled: return
+    stack = getStack()
+    if stack: stack[-1].nEvents = (stack[-1].nEvents or 0) + int(nEvents)
+
+def addBytes(nBytes):
+    # adds read bytes to the innermost running stage of this thread
+    if not enabled: return
+    stack = getStack()
+    if stack: stack[-1].nBytes = (stack[-1].nBytes or 0) + int(nBytes)
+
+
+def instrument(name = None, events = None):
+    # decorator recording every call of a function as a stage
+    # events: optional function that returns the number of events from the result of the function
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled: return function(*args, **kwargs)
+            with Stage(stage_name) as running:
+                result = function(*args, **kwargs)
+                if events is not None: running.nEvents = events(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def iterate(name, iterable, events = None, bytesRead = None, firstChunk = 0):
+    # records the time needed to produce every item of an iterable (e.g. the chunks of uproot's iterate) as a stage
+    # events: optional function that returns the number of events of an item
+    # bytesRead: optional function that returns the total number of bytes read so far, the difference is recorded
+    if not enabled: return iterable
+    return iterateChunks(name, iterable, events, bytesRead, firstChunk)
+
+def iterateChunks(name, iterable, events, bytesRead, firstChunk):
+    iterator = iter(iterable)
+    end = object()
+    chunk = firstChunk
+    while True:
+        with Stage(name, chunk = chunk) as running:
+            nBytes = bytesRead() if bytesRead else None
+            item = next(iterator, end)
+            # the last call (that only finds the end) is not recorded
+            if item is end: running.discard = True
+            else:
+                if events is not None: running.nEvents = events(item)
+                if bytesRead: running.nBytes = bytesRead() - nBytes
+        if item is end: return
+        yield item
+        chunk += 1
+
+
+def summary():
+    # one line per stage: number of calls, events, total time, events per second, MB read and the memory peak
+    columns = ["stage", "calls", "nEvents", "time [s]", "events/s", "read [MB]", "peak [MB]"]
+    if not records: return pd.DataFrame(columns = columns)
+
+    df = pd.DataFrame(records)
+    grouped = df.groupby("stage", sort = False)
+    table = pd.DataFrame({
+        "calls": grouped.size(),
+        "nEvents": grouped["nEvents"].sum(min_count = 1),
+        "time [s]": grouped["time"].sum(),
+        "read [MB]": grouped["nBytes"].sum(min_count = 1) / 1e6,
+        "peak [MB]": grouped["peak"].max(),
+    })
+    table["events/s"] = table["nEvents"] / table["time [s]"]
+    return table.reset_index()[columns]
+
+def printSummary():
+    print(summary().to_string(index = False, float_format = lambda value: "%.3f" % value))
+
+
+def saveTrace(filename):
+    # stores all records in the trace event format (chrome://tracing, perfetto), with the
+    # events, bytes and memory peak of every stage as arguments
+    pid = os.getpid()
+    events = []
+    for record in records:
+        events.append({"name": record["stage"], "ph": "X", "pid": pid, "tid": record["thread"],
+                       "ts": record["start"] * 1e6, "dur": record["time"] * 1e6,
+                       "args": {key:record[key] for key in ["chunk", "nEvents", "nBytes", "peak"] if record[key] is not None}})
+
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                   "otherData": {"memory": "tracemalloc peak per stage [MB]" if trace_memory else "max RSS of the process [MB]"}}, f)
@@ -5,7 +5,14 @@ import pandas as pd
 import numpy as np
 import awkward as ak
 from glob import glob
+from functools import partial, lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import re
+import os
+import json
+import hashlib
+from collections.abc import Mapping
+import instrumentation
 vector.register_awkward()
 
 # Functions to load data from various sources and output it in a format usable by our networks
@@ -18,11 +25,49 @@ vector.register_awkward()
 # - L1 jets (awkward array of pt, eta, phi and more)
 # - L1 energy sums ((awkward array of pt, eta, phi and more))
 # - L1 bits of cutbased triggers, and total L1 bit (pandas dataframe)
+# - optional for dense inputs (anomaly team h5s): the same objects as padded numpy arrays. These are not an
+#   entry of the dict (all entries are object collections), the dict has an attribute "dense" instead, which
+#   gives the views of the data cube per collection (use getattr(data, "dense", None), it is missing for the other readers)
 # all of these should have then same length!
 # maybe we should store the output in a dict to make everything a bit less lengthy
 
 # I created two functions for h5s, as the signal one contains multiple signals that we (might) want to load individually
 
+# the slices of the different objects in the (N,19,3) anomaly team data cubes: MET, 4 egammas, 4 muons, 10 jets
+# (this is the only definition of the layout, preprocessing uses it as well)
+anomaly_slices = {
+    "energysums": slice(0,1),
+    "egammas": slice(1,5),
+    "muons": slice(5,9),
+    "jets": slice(9,19),
+}
+
+def anomalyCubeToDense(data):
+    # splits an anomaly team data cube into (N, nObjects, 3) views per collection, without copying anything
+    # entries are (pt, eta, phi), empty objects have pt = 0
+    # the full (N,19,3) cube is kept as well ("cube"), the anomaly detection inputs use it directly
+    dense = {collection:data[:,object_slice,:] for collection, object_slice in anomaly_slices.items()}
+    dense["cube"] = data
+    return dense
+
+def anomalyCubeToAwkward(data, collection):
+    # converts one object collection of an anomaly team data cube to awkward
+    np_objects = data[:,anomaly_slices[collection],:]
+    
+    # energy sums are handled a bit differently
+    if collection == "energysums":
+        ak_energysums = ak.zip( {key:ak.from_regular(np_objects[:,:,2*i], axis = 1) for i, key in enumerate(["pt","phi"])}, with_name = "Momentum4D")
+        ak_energysums["Type"] = [2] * len(ak_energysums) # MET should have Type 2
+        return ak_energysums
+    
+    # converting to awkward (thanks Artur for the code)
+    ak_objects = ak.zip( {key:ak.from_regular(np_objects[:,:,i], axis = 1) for i,key in enumerate(["pt","eta","phi"])}, with_name = "Momentum4D")
+    
+    # removing empty entries (not needed for energy sums)
+    return ak_objects[ak_objects.pt > 0]
+
+
+@instrumentation.instrument(events = lambda result: result[0]["nEvents"])
 def readFromAnomalySignalh5(inputfile, process, moreInfo=None, verbosity = 0):
 
     if(verbosity > 0): print("Reading anomaly team preprocessed signal file at " + inputfile + " for process " + process + ".")
@@ -47,34 +92,21 @@ def readFromAnomalySignalh5(inputfile, process, moreInfo=None, verbosity = 0):
             if key.startswith(process + "_L1_"):
                 L1bits_labels.append(key.replace(process+"_", ""))
                 L1bits.append(np.array(h5f2[key]))
+                instrumentation.addBytes(h5f2[key].nbytes)
             elif key == process + "_l1bit":
                 L1bit = np.array(h5f2[key])
+                instrumentation.addBytes(h5f2[key].nbytes)
 
             # doing this should remove all trigger things, and leave a single entry with the data
             if len(h5f2[key].shape) < 3: continue
-            if key == process: data = h5f2[key][:,:,:].astype("float")
-    
-    # splitting objects
-    np_energysums = data[:,0,:].reshape( (data.shape[0], 1, 3) ) # reshape is needed to keep dimensionality
-    np_egammas = data[:,1:4,:]
-    np_muons = data[:,5:8,:]
-    np_jets = data[:,9:19,:]
-    
-    # converting to awkward (thanks Artur for the code)
-    ak_egammas = ak.zip( {key:ak.from_regular(np_egammas[:,:,i], axis = 1) for i,key in enumerate(["pt","eta","phi"])}, with_name = "Momentum4D")
-    ak_muons = ak.zip( {key:ak.from_regular(np_muons[:,:,i], axis = 1) for i,key in enumerate(["pt","eta","phi"])}, with_name = "Momentum4D")
-    ak_jets = ak.zip( {key:ak.from_regular(np_jets[:,:,i], axis = 1) for i,key in enumerate(["pt","eta","phi"])}, with_name = "Momentum4D")
+            if key == process:
+                data = h5f2[key][:,:,:]
+                instrumentation.addBytes(h5f2[key].nbytes)
     
-    # energy sums are handled a bit differently
-    ak_energysums = ak.zip( {key:ak.from_regular(np_energysums[:,:,2*i], axis = 1) for i, key in enumerate(["pt","phi"])}, with_name = "Momentum4D")
-    ak_energysums["Type"] = [2] * len(ak_energysums) # MET should have Type 2
-    
-    # removing empty entries (not needed for energy sums)
-    ak_egammas = ak_egammas[ak_egammas.pt > 0]
-    ak_muons = ak_muons[ak_muons.pt > 0]
-    ak_jets = ak_jets[ak_jets.pt > 0]
+    # splitting objects, they are converted to awkward when they are used first
+    dataDict = LazyDataDict(data)
     
-    infoDict["nEvents"] = len(ak_muons)
+    infoDict["nEvents"] = len(data)
     
     # formating the L1 bits
     df_total_L1 = pd.DataFrame( {"total L1": L1bit} )
@@ -85,17 +117,11 @@ def readFromAnomalySignalh5(inputfile, process, moreInfo=None, verbosity = 0):
     if moreInfo: infoDict = {**infoDict, **moreInfo}
         
     if(verbosity > 0): print("Done!")
-        
-    # we'll output the data as a dict, makes it easier later
-    dataDict = {}
-    dataDict["muons"] = ak_muons
-    dataDict["egammas"] = ak_egammas
-    dataDict["jets"] = ak_jets
-    dataDict["energysums"] = ak_energysums
     
     return infoDict, dataDict, df_bits
 
 
+@instrumentation.instrument(events = lambda result: result[0]["nEvents"])
 def readFromAnomalyBackgroundh5(inputfile, moreInfo=None, verbosity = 0):
     
     if(verbosity > 0): print("Reading anomaly team preprocessed background file at " + inputfile + ".")
@@ -120,12 +146,15 @@ def readFromAnomalyBackgroundh5(inputfile, moreInfo=None, verbosity = 0):
             if key[:3] == "L1_":
                 L1bits_labels.append(key)
                 L1bits.append(np.array(h5f2[key]))
+                instrumentation.addBytes(h5f2[key].nbytes)
             elif key == "L1bit":
                 L1bit = np.array(h5f2[key])
+                instrumentation.addBytes(h5f2[key].nbytes)
 
             if len(h5f2[key].shape) < 3: continue
             if key == "full_data_cyl":
-                data = h5f2[key][:,:,:].astype("float")
+                data = h5f2[key][:,:,:]
+                instrumentation.addBytes(h5f2[key].nbytes)
 
     # we have 57 variables, but they do not have labels yet. Lets assign them based on the info in
     # https://gitlab.cern.ch/cms-l1-ad/l1_anomaly_ae/-/blob/master/in/prep_data.py
@@ -133,27 +162,10 @@ def readFromAnomalyBackgroundh5(inputfile, moreInfo=None, verbosity = 0):
     # These are 19 objects, times 3 parameters -> 57 vars
     # From line 27 I think the order is as I listed it: MET, egammas, muons, jets
         
-    # splitting objects
-    np_energysums = data[:,0,:].reshape( (data.shape[0], 1, 3) ) # reshape is needed to keep dimensionality
-    np_egammas = data[:,1:4,:]
-    np_muons = data[:,5:8,:]
-    np_jets = data[:,9:19,:]
+    # splitting objects, they are converted to awkward when they are used first
+    dataDict = LazyDataDict(data)
     
-    # converting to awkward (thanks Artur for the code)
-    ak_egammas = ak.zip( {key:ak.from_regular(np_egammas[:,:,i], axis = 1) for i,key in enumerate(["pt","eta","phi"])}, with_name = "Momentum4D")
-    ak_muons = ak.zip( {key:ak.from_regular(np_muons[:,:,i], axis = 1) for i,key in enumerate(["pt","eta","phi"])}, with_name = "Momentum4D")
-    ak_jets = ak.zip( {key:ak.from_regular(np_jets[:,:,i], axis = 1) for i,key in enumerate(["pt","eta","phi"])}, with_name = "Momentum4D")
-    
-    # energy sums are handled a bit differently
-    ak_energysums = ak.zip( {key:ak.from_regular(np_energysums[:,:,2*i], axis = 1) for i, key in enumerate(["pt","phi"])}, with_name = "Momentum4D")
-    ak_energysums["Type"] = [2] * len(ak_energysums) # MET should have Type 2
-    
-    # removing empty entries (not needed for energy sums)
-    ak_egammas = ak_egammas[ak_egammas.pt > 0]
-    ak_muons = ak_muons[ak_muons.pt > 0]
-    ak_jets = ak_jets[ak_jets.pt > 0]
-    
-    infoDict["nEvents"] = len(ak_muons)
+    infoDict["nEvents"] = len(data)
     
     # formating the L1 bits
     df_total_L1 = pd.DataFrame( {"total L1": L1bit} )
@@ -164,19 +176,361 @@ def readFromAnomalyBackgroundh5(inputfile, moreInfo=None, verbosity = 0):
     if moreInfo: infoDict = {**infoDict, **moreInfo}
         
     if(verbosity > 0): print("Done!")
+    
+    return infoDict, dataDict, df_bits
+    
+
+
+class LazyDataDict(Mapping):
+    # a dataDict for the anomaly team files that only converts an object collection to awkward when it is accessed
+    # (the conversions are cached, so every collection is converted at most once)
+    # the data cube keeps the dtype of the file, the attribute "dense" gives its views per collection
+    def __init__(self, data):
+        self.data = data
+        self.collections = {}
+    
+    @property
+    def dense(self):
+        return anomalyCubeToDense(self.data)
+    
+    def __getitem__(self, collection):
+        if collection not in anomaly_slices: raise KeyError(collection)
+        if collection not in self.collections:
+            self.collections[collection] = anomalyCubeToAwkward(self.data, collection)
+        return self.collections[collection]
+    
+    def __iter__(self):
+        return iter(["muons", "egammas", "jets", "energysums"])
+    
+    def __len__(self):
+        return 4
+
+
+class LazyAnomalyh5:
+    # lazy reader for the anomaly team h5 files
+    # the data cube stays on disk: event ranges are read on demand (via memory-mapping if the dataset is
+    # stored contiguously and uncompressed, and via h5py otherwise), in the native dtype of the file
+    #
+    # usage:
+    # with LazyAnomalyh5(inputfile) as reader:                   # background file
+    # with LazyAnomalyh5(inputfile, process = "haa4b") as reader: # signal file
+    #     for info, data, bits in reader.iterate(step_size = 100000):
+    #         ...
+    def __init__(self, inputfile, process=None, moreInfo=None, verbosity=0):
+        
+        if(verbosity > 0): print("Opening anomaly team preprocessed file at " + inputfile + " lazily.")
+        self.inputfile = inputfile
+        self.process = process
+        self.moreInfo = moreInfo
+        self.verbosity = verbosity
+        
+        # signal files have one set of keys per process, prefixed by the process name
+        if process:
+            data_key = process
+            L1bit_key = process + "_l1bit"
+            L1bits_prefix = process + "_L1_"
+        else:
+            data_key = "full_data_cyl"
+            L1bit_key = "L1bit"
+            L1bits_prefix = "L1_"
+        
+        self.h5file = h5py.File(inputfile, 'r')
+        self.dataset = self.h5file[data_key]
+        self.L1bit = self.h5file[L1bit_key]
+        self.L1bits = {key[len(L1bits_prefix)-3:]:self.h5file[key] for key in self.h5file.keys() if key.startswith(L1bits_prefix)}
         
+        # memory-mapping only works if the data is stored as one contiguous block
+        self.memmap = None
+        offset = self.dataset.id.get_offset()
+        if self.dataset.chunks is None and self.dataset.compression is None and offset is not None:
+            self.memmap = np.memmap(inputfile, mode = 'r', dtype = self.dataset.dtype, offset = offset, shape = self.dataset.shape)
+        if(verbosity > 0): print("Found %i events, reading them %s." % (len(self), "memory-mapped" if self.memmap is not None else "via h5py"))
+    
+    def __len__(self):
+        return self.dataset.shape[0]
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        self.memmap = None
+        self.h5file.close()
+    
+    def readData(self, start=None, stop=None):
+        # returns the (stop-start,19,3) data cube of the event range
+        # for memory-mapped files, this is a view and nothing is read before it is used
+        if self.memmap is not None: return self.memmap[start:stop]
+        return self.dataset[start:stop]
+    
+    def readBits(self, start=None, stop=None):
+        # formating the L1 bits
+        df_total_L1 = pd.DataFrame( {"total L1": self.L1bit[start:stop]} )
+        df_trigger_bits = pd.DataFrame({key:dataset[start:stop] for key, dataset in self.L1bits.items()})
+        return df_total_L1.join(df_trigger_bits)
+    
+    @instrumentation.instrument("LazyAnomalyh5.getChunk", events = lambda result: result[0]["nEvents"])
+    def getChunk(self, start=None, stop=None):
+        # returns the usual infoDict, dataDict and L1 bits for an event range
+        # the object collections in the dataDict are only converted to awkward when accessed
+        start, stop, _ = slice(start, stop).indices(len(self))
+        
+        infoDict = {}
+        infoDict["input"] = self.inputfile
+        infoDict["entry_start"] = start
+        infoDict["entry_stop"] = stop
+        infoDict["nEvents"] = stop - start
+        if self.moreInfo: infoDict = {**infoDict, **self.moreInfo}
+        
+        # for memory-mapped files, the data cube is only read when it is used, these bytes are counted here anyway
+        instrumentation.addBytes( (stop - start) * (self.dataset.dtype.itemsize * int(np.prod(self.dataset.shape[1:])) + self.L1bit.dtype.itemsize * (len(self.L1bits) + 1)) )
+        
+        return infoDict, LazyDataDict(self.readData(start, stop)), self.readBits(start, stop)
+    
+    def iterate(self, step_size=100000):
+        # yields chunks of at most step_size events
+        for start in range(0, len(self), step_size):
+            if(self.verbosity > 1): print("Reading events %i to %i." % (start, min(start + step_size, len(self))))
+            yield self.getChunk(start, start + step_size)
+
+
+# all branches of the L1 ntuple event tree that we need, grouped by object
+L1Ntuple_branches = {
+    "muon": ["muonEt", "muonEta", "muonPhi"],
+    "eg": ["egEt", "egEta", "egPhi"],
+    "jet": ["jetEt", "jetEta", "jetPhi"],
+    "sum": ["sumType", "sumEt", "sumPhi"],
+}
+
+def splitL1NtupleObjects(arrays):
+    # splits the output of a single tree.arrays call into muons, egammas, jets and energy sums
+    return tuple( arrays[[key for key in arrays.fields if key in branches]] for branches in L1Ntuple_branches.values() )
+
+def readL1NtupleObjects(tree, entry_start=None, entry_stop=None):
+    # reads muons, egammas, jets and energy sums from one L1 ntuple event tree
+    # entry_start and entry_stop can be used to only read a range of events
+    # all branches are read in a single pass, and split afterwards
+    
+    arrays = tree.arrays(filter_name = sum(L1Ntuple_branches.values(), []), entry_start = entry_start, entry_stop = entry_stop)
+    
+    return splitL1NtupleObjects(arrays)
+
+
+def formatL1NtupleObjects(muons, egammas, jets, energysums):
+    # using Momentum4D to get pt, eta and phi
+    muons = ak.zip({key.replace("muon","").replace("Eta","eta").replace("Phi","phi").replace("Et","pt"):muons[key] for key in muons.fields}, with_name = "Momentum4D")
+    egammas = ak.zip({key.replace("eg","").replace("Eta","eta").replace("Phi","phi").replace("Et","pt"):egammas[key] for key in egammas.fields}, with_name = "Momentum4D")
+    jets = ak.zip({key.replace("jet","").replace("Eta","eta").replace("Phi","phi").replace("Et","pt"):jets[key] for key in jets.fields}, with_name = "Momentum4D")
+    energysums = ak.zip({key.replace("sum","").replace("Phi","phi").replace("Et","pt"):energysums[key] for key in energysums.fields})
+    
     # we'll output the data as a dict, makes it easier later
     dataDict = {}
-    dataDict["muons"] = ak_muons
-    dataDict["egammas"] = ak_egammas
-    dataDict["jets"] = ak_jets
-    dataDict["energysums"] = ak_energysums
+    dataDict["muons"] = muons
+    dataDict["egammas"] = egammas
+    dataDict["jets"] = jets
+    dataDict["energysums"] = energysums
     
-    return infoDict, dataDict, df_bits
+    return dataDict
+
+
+def loadPrescaleTable(prescale_file_name):
+    # we need to make sure to apply prescales properly!
+    # as the anomaly team does it, we only use un-prescaled paths
+    # returns a dict of all un-prescaled seeds and their bit index in the menu
+    # the table is only parsed once per prescale file (as long as the file does not change)
+    return parsePrescaleTable(prescale_file_name, os.stat(prescale_file_name).st_mtime_ns)
+
+@lru_cache(maxsize=None)
+def parsePrescaleTable(prescale_file_name, mtime):
+    with open(prescale_file_name) as prescale_file:
+        prescale_table = {line.split(',')[1]:int(line.split(',')[0]) for line in prescale_file if line.split(',')[4] == "1"}
+    
+    return prescale_table
+
+
+@lru_cache(maxsize=16)
+def getBitPositions(aliases, prescale_items, bitIndexFromPrescale=False):
+    # translates the uGT aliases of a menu into the positions of the wanted seeds in m_algoDecisionFinal
+    # aliases and prescale_items are tuples of (name, value) pairs, so that the result can be cached per menu
+    # returns the seed names and a numpy array of positions, both in the order of the aliases
+    # bitIndexFromPrescale: for files without aliases (e.g. privately produced ones), use the bit index of the prescale
+    # file instead. This is only correct if the files were produced with exactly the menu of the prescale file,
+    # so it has to be requested explicitly
+    prescale_table = dict(prescale_items)
+    
+    labels = []
+    positions = []
+    for alias, decision_index_string in aliases:
+        if alias in prescale_table:
+            labels.append(alias)
+            positions.append( int(re.match(r"L1uGT\.m_algoDecisionInitial\[([0-9]+)\]", decision_index_string).group(1)) )
+    
+    if not aliases:
+        if not bitIndexFromPrescale: raise Exception("The uGT tree has no aliases, pass bitIndexFromPrescale = True to use the bit index of the prescale file.")
+        labels = list(prescale_table.keys())
+        positions = list(prescale_table.values())
+    
+    return labels, np.asarray(positions, dtype=np.int64)
+
+
+def readL1NtupleBitMatrix(tree, prescale_table, entry_start=None, entry_stop=None, packed=False, bitIndexFromPrescale=False):
+    # reading the L1 trigger results
+    # for this, we need to use the aliases in l1uGTTree/L1uGTTree (see getBitPositions for files without aliases)
+    # returns the seed labels, the total L1 bit and a (nEvents, nSeeds) boolean matrix of the seed decisions
+    # with packed = True, the matrix is bit-packed along the seeds (np.packbits, 8 seeds per byte)
+    labels, positions = getBitPositions(tuple(tree.aliases.items()), tuple(prescale_table.items()), bitIndexFromPrescale)
+    
+    decisions = tree["L1uGT/m_algoDecisionFinal"].array(entry_start = entry_start, entry_stop = entry_stop)
+    decisions = ak.to_numpy(ak.to_regular(decisions, axis=1))
+    
+    # a single gather for all wanted seeds
+    bit_matrix = decisions[:,positions].astype(bool, copy=False)
+    
+    # calculating the total L1 bis, as the one stored in L1 ntuples also consideres prescaled paths
+    # (as a L1_AlwaysTrue is contained, the total L1 bit is just true everywhere)
+    total_L1_bit = bit_matrix.any(axis=1)
+    
+    if packed: bit_matrix = np.packbits(bit_matrix, axis=1)
+    
+    return labels, total_L1_bit, bit_matrix
+
+
+def readL1NtupleBits(tree, prescale_table, entry_start=None, entry_stop=None, bitIndexFromPrescale=False):
+    labels, total_L1_bit, bit_matrix = readL1NtupleBitMatrix(tree, prescale_table, entry_start = entry_start, entry_stop = entry_stop, bitIndexFromPrescale = bitIndexFromPrescale)
+    
+    df_bits = pd.DataFrame(bit_matrix, columns=labels)
+    df_bits.insert(0, "total L1", total_L1_bit)
+    
+    return df_bits
+
+
+@instrumentation.instrument(events = lambda result: len(result[0]))
+def readL1NtupleFile(filepath, prescale_table, eventTree="l1UpgradeEmuTree/L1UpgradeTree", L1bitTree="l1uGTTree/L1uGTTree", bitIndexFromPrescale=False):
+    # reads objects and L1 bits of a single L1 ntuple file
+    # this is a module level function so that it can be sent to worker processes
+    with uproot.open(filepath) as file:
+        muons, egammas, jets, energysums = readL1NtupleObjects(file[eventTree])
+        bits = readL1NtupleBits(file[L1bitTree], prescale_table, bitIndexFromPrescale = bitIndexFromPrescale)
+        instrumentation.addBytes(file.file.source.num_requested_bytes)
+    
+    return muons, egammas, jets, energysums, bits
+
+
+# a simple on-disk cache for loaded datasets
+# the normalized dataDict is stored as parquet (via awkward), the L1 bits as parquet (via pandas)
+# and the infoDict as json. The cache key is built from everything that changes the output,
+# so a changed input file, tree name or prescale file automatically leads to a new entry
+def getCacheKey(filepaths, *args):
+    # filepaths: all files that are read; their modification time and size enter the key
+    # args: any further settings (tree names, ...) that change the output
+    hasher = hashlib.sha1()
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        hasher.update(("%s:%i:%i;" % (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)).encode())
+    for arg in args:
+        hasher.update((str(arg) + ";").encode())
+    return hasher.hexdigest()
+
+
+def writeToCache(cache_dir, key, infoDict, dataDict, bits):
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    # writing to a temporary name first, so that an interrupted write does not leave a broken cache entry
+    ak.to_parquet(ak.zip(dataDict, depth_limit = 1), os.path.join(cache_dir, key + "_data.parquet.tmp"))
+    bits.to_parquet(os.path.join(cache_dir, key + "_bits.parquet.tmp"))
+    with open(os.path.join(cache_dir, key + "_info.json.tmp"), "w") as f:
+        json.dump(infoDict, f)
+    
+    # the info file is moved last, as it marks the entry as complete
+    for suffix in ["_data.parquet", "_bits.parquet", "_info.json"]:
+        os.replace(os.path.join(cache_dir, key + suffix + ".tmp"), os.path.join(cache_dir, key + suffix))
+
+
+def readFromCache(cache_dir, key):
+    # returns None if the dataset is not cached yet
+    if not os.path.exists(os.path.join(cache_dir, key + "_info.json")): return None
+    
+    with open(os.path.join(cache_dir, key + "_info.json")) as f:
+        infoDict = json.load(f)
+    data = ak.from_parquet(os.path.join(cache_dir, key + "_data.parquet"))
+    dataDict = {field:data[field] for field in data.fields}
+    bits = pd.read_parquet(os.path.join(cache_dir, key + "_bits.parquet"))
+    
+    return infoDict, dataDict, bits
+
+
+def readCached(cache_dir, cache_key, moreInfo=None, verbosity=0):
+    # the cached (infoDict, dataDict, bits) of a reader, with moreInfo added, or None if the dataset is not cached yet
+    cached = readFromCache(cache_dir, cache_key)
+    if cached is None: return None
+    
+    if(verbosity > 0): print("Loaded dataset from cache in " + cache_dir + ".")
+    infoDict, dataDict, bits = cached
+    if moreInfo: infoDict = {**infoDict, **moreInfo}
+    return infoDict, dataDict, bits
+
+
+def readFiles(readFile, filepaths, nWorkers=1, useThreads=False, verbosity=0):
+    # applies readFile to every file, nWorkers > 1 reads the files in parallel, using a process pool
+    # (or a thread pool if useThreads is set)
+    # the results are always in the order of filepaths, independent of the number of workers
+    if nWorkers <= 1: return [readFile(filepath) for filepath in filepaths]
+    
+    if(verbosity > 0): print("Using %i %s." % (nWorkers, "threads" if useThreads else "processes"))
+    Executor = ThreadPoolExecutor if useThreads else ProcessPoolExecutor
+    with Executor(max_workers = nWorkers) as executor:
+        # map keeps the order of the inputs
+        return list(executor.map(readFile, filepaths))
+
+
+def finishDataset(infoDict, dataDict, bits, moreInfo=None, cache_dir=None, cache_key=None, verbosity=0):
+    # the common end of the readers: counting the events, storing the dataset in the cache and adding moreInfo
+    infoDict["nEvents"] = len(dataDict["muons"])
+    
+    if cache_dir:
+        if(verbosity > 0): print("Writing dataset to cache in " + cache_dir + "...")
+        writeToCache(cache_dir, cache_key, infoDict, dataDict, bits)
+    
+    # after everything else: add moreInfo
+    if moreInfo: infoDict = {**infoDict, **moreInfo}
+        
+    if(verbosity > 0): print("Done!")
     
+    return infoDict, dataDict, bits
+
+
+def iterateTree(file, tree, filter_name, step_size, name, firstChunk=0, decompression_executor=None):
+    # uproot's iterate over the branches of one tree, it takes care of the basket-aware reading
+    # yields (arrays, report) per chunk; with the instrumentation enabled, reading every chunk is recorded as a stage
+    chunks = tree.iterate(filter_name = filter_name, step_size = step_size, report = True, decompression_executor = decompression_executor)
+    return instrumentation.iterate(name, chunks, events = lambda item: len(item[0]),
+                                   bytesRead = lambda: file.file.source.num_requested_bytes, firstChunk = firstChunk)
 
 
-def readFromL1Ntuple(inputpath, prescale_file_name, eventTree="l1UpgradeEmuTree/L1UpgradeTree", L1bitTree="l1uGTTree/L1uGTTree", moreInfo=None, verbosity=0):
+def chunkInfoDict(infoDict, filepath, iChunk, report, nEvents, moreInfo=None):
+    # the information dict of one chunk of the streaming readers:
+    # the entries of the whole dataset (infoDict), plus the file and the entry range of the chunk
+    chunkInfo = dict(infoDict)
+    chunkInfo["file"] = filepath
+    chunkInfo["chunk"] = iChunk
+    chunkInfo["entry_start"] = report.tree_entry_start
+    chunkInfo["entry_stop"] = report.tree_entry_stop
+    chunkInfo["nEvents"] = nEvents
+    
+    # after everything else: add moreInfo
+    if moreInfo: chunkInfo = {**chunkInfo, **moreInfo}
+    
+    return chunkInfo
+
+
+@instrumentation.instrument(events = lambda result: result[0]["nEvents"])
+def readFromL1Ntuple(inputpath, prescale_file_name, eventTree="l1UpgradeEmuTree/L1UpgradeTree", L1bitTree="l1uGTTree/L1uGTTree", moreInfo=None, nWorkers=1, useThreads=False, cache_dir=None, bitIndexFromPrescale=False, verbosity=0):
+    # nWorkers > 1 reads the files in parallel, using a process pool (or a thread pool if useThreads is set)
+    # the output is always in the (sorted) order of the input files, independent of the number of workers
+    # if cache_dir is given, the loaded dataset is stored there and reloaded on the next call
+    # bitIndexFromPrescale: allow files without uGT aliases, see getBitPositions
     
     if(verbosity > 0): print("Reading from L1 ntuples in " + inputpath + ".")
     
@@ -190,98 +544,229 @@ def readFromL1Ntuple(inputpath, prescale_file_name, eventTree="l1UpgradeEmuTree/
     infoDict["L1bittree"] = L1bitTree
     
     # reading the particles
-    filepaths = glob(inputpath + "/*.root")
+    # sorting the files, so that the event order does not depend on the file system
+    filepaths = sorted(glob(inputpath + "/*.root"))
     if(verbosity > 0): print("Found %i files." % len(filepaths))
     infoDict["nFiles"] = len(filepaths)
-
-    trees = []
-    L1bittrees = []
-    for filepath in filepaths:
-        file = uproot.open(filepath)
-        trees.append( file[eventTree] )
-        L1bittrees.append( file[L1bitTree] )
     
-    if(verbosity > 0): print("Starting to read objects...")
-        
-    particle_fields = ["Et", "Eta", "Phi"]
-    energysum_fields = ["Type", "Et", "Phi"]
+    cache_key = getCacheKey(filepaths + [prescale_file_name], "L1Ntuple", inputpath, eventTree, L1bitTree, bitIndexFromPrescale) if cache_dir else None
+    if cache_dir:
+        cached = readCached(cache_dir, cache_key, moreInfo = moreInfo, verbosity = verbosity)
+        if cached: return cached
     
-    muons = []
-    egammas = []
-    jets = []
-    energysums = []
-            
-    for tree in trees:
-        muons.append(tree.arrays(filter_name = ["muon" + f for f in particle_fields]))
-        egammas.append(tree.arrays(filter_name = ["eg" + f for f in particle_fields]))
-        jets.append(tree.arrays(filter_name = ["jet" + f for f in particle_fields]))
-        energysums.append(tree.arrays(filter_name = ["sum" + f for f in energysum_fields]))
-        
-    muons = ak.concatenate(muons, axis = 0)
-    egammas = ak.concatenate(egammas, axis = 0)
-    jets = ak.concatenate(jets, axis = 0)
-    energysums = ak.concatenate(energysums, axis = 0)
-        
-    # using Momentum4D to get pt, eta and phi
-    muons = ak.zip({key.replace("muon","").replace("Eta","eta").replace("Phi","phi").replace("Et","pt"):muons[key] for key in muons.fields}, with_name = "Momentum4D")
-    egammas = ak.zip({key.replace("eg","").replace("Eta","eta").replace("Phi","phi").replace("Et","pt"):egammas[key] for key in egammas.fields}, with_name = "Momentum4D")
-    jets = ak.zip({key.replace("jet","").replace("Eta","eta").replace("Phi","phi").replace("Et","pt"):jets[key] for key in jets.fields}, with_name = "Momentum4D")
-    energysums = ak.zip({key.replace("sum","").replace("Phi","phi").replace("Et","pt"):energysums[key] for key in energysums.fields})
+    # the prescale file only has to be read once
+    prescale_table = loadPrescaleTable(prescale_file_name)
     
-    infoDict["nEvents"] = len(muons)
+    if(verbosity > 0): print("Starting to read objects and L1 trigger bits...")
     
-    if(verbosity > 0): print("Starting to read L1 trigger bits...")
-    # reading the L1 trigger results
-    # for this, we need to use the aliases in l1uGTTree/L1uGTTree   
-    bits_part = []
-    for tree in L1bittrees:
-        
-        # we need to make sure to apply prescales properly!
-        # as the anomaly team does it, we only use un-prescaled paths
-        with open(prescale_file_name) as prescale_file:
-            wanted_keys = [line.split(',')[1] for line in prescale_file if line.split(',')[4] == "1"]
-        
-        decisions = tree["L1uGT/m_algoDecisionFinal"].array()
-        
-        resultdict = {}
+    if(verbosity > 0 and bitIndexFromPrescale): print("Files without uGT aliases use the bit index of " + prescale_file_name + ".")
+    readFile = partial(readL1NtupleFile, prescale_table = prescale_table, eventTree = eventTree, L1bitTree = L1bitTree, bitIndexFromPrescale = bitIndexFromPrescale)
+    results = readFiles(readFile, filepaths, nWorkers = nWorkers, useThreads = useThreads, verbosity = verbosity)
+    
+    muons = ak.concatenate([result[0] for result in results], axis = 0)
+    egammas = ak.concatenate([result[1] for result in results], axis = 0)
+    jets = ak.concatenate([result[2] for result in results], axis = 0)
+    energysums = ak.concatenate([result[3] for result in results], axis = 0)
+    bits = pd.concat([result[4] for result in results])
+    del results
         
-        aliases = tree.aliases
-        for alias in aliases:
-            if alias in wanted_keys:
-                decision_index_string = aliases[alias]
-                decision_position = int(re.match(r"L1uGT\.m_algoDecisionInitial\[([0-9]+)\]", decision_index_string).group(1))
+    dataDict = formatL1NtupleObjects(muons, egammas, jets, energysums)
+    
+    return finishDataset(infoDict, dataDict, bits, moreInfo = moreInfo, cache_dir = cache_dir, cache_key = cache_key, verbosity = verbosity)
 
-                resultdict[alias] = decisions[:,decision_position]
-        
-        # calculating the total L1 bis, as the one stored in L1 ntuples also consideres prescaled paths
-        # (as a L1_AlwaysTrue is contained, the total L1 bit is just true everywhere)
-        total_L1_bit = np.any( np.asarray(  list(resultdict.values()) ) , axis=0 ).flatten()
-                
-        df_total_L1 = pd.DataFrame( {"total L1": total_L1_bit} )
-        df_trigger_bits = pd.DataFrame(resultdict)
-        df_bits = df_total_L1.join(df_trigger_bits)
-        bits_part.append(df_bits)
+
+def iterateL1Ntuple(inputpath, prescale_file_name, step_size=100000, eventTree="l1UpgradeEmuTree/L1UpgradeTree", L1bitTree="l1uGTTree/L1uGTTree", moreInfo=None, nWorkers=1, bitIndexFromPrescale=False, verbosity=0):
+    # streaming version of readFromL1Ntuple
+    # instead of reading everything into memory, this yields (infoDict, dataDict, bits) for chunks
+    # of at most step_size events (chunks never span multiple files), so everything downstream
+    # (preprocessing, inference, rate counting) can run with constant memory
+    #
+    # usage:
+    # for info, data, bits in iterateL1Ntuple(path, prescale_file):
+    #     x = prepareData(model_dir, data)
+    #     ...
+    #
+    # chunks are yielded one after the other, so nWorkers > 1 parallelizes the basket decompression
+    # within each chunk instead of reading multiple files at once
     
-    bits = pd.concat(bits_part)
+    if(verbosity > 0): print("Iterating over L1 ntuples in " + inputpath + " in chunks of " + str(step_size) + " events.")
+    
+    filepaths = sorted(glob(inputpath + "/*.root"))
+    if(verbosity > 0): print("Found %i files." % len(filepaths))
+    
+    # the entries that are the same for all chunks
+    infoDict = {}
+    infoDict["input"] = inputpath
+    infoDict["eventtree"] = eventTree
+    infoDict["L1bittree"] = L1bitTree
+    infoDict["nFiles"] = len(filepaths)
+    
+    decompression_executor = uproot.ThreadPoolExecutor(max_workers = nWorkers) if nWorkers > 1 else None
+    
+    # the prescale file only has to be read once
+    prescale_table = loadPrescaleTable(prescale_file_name)
+    if(verbosity > 0 and bitIndexFromPrescale): print("Files without uGT aliases use the bit index of " + prescale_file_name + ".")
+    
+    iChunk = 0
+    try:
+        for iFile, filepath in enumerate(filepaths):
+            with uproot.open(filepath) as file:
+                L1bittree = file[L1bitTree]
+                
+                # the bits are read for the same entry range as the objects
+                # (with the instrumentation enabled, formating every chunk is recorded as a separate stage)
+                for arrays, report in iterateTree(file, file[eventTree], sum(L1Ntuple_branches.values(), []), step_size, "readL1NtupleChunk",
+                                                  firstChunk = iChunk, decompression_executor = decompression_executor):
+                    
+                    with instrumentation.stage("formatL1NtupleChunk", chunk = iChunk, nEvents = len(arrays)) as stage:
+                        nBytes = file.file.source.num_requested_bytes
+                        
+                        muons, egammas, jets, energysums = splitL1NtupleObjects(arrays)
+                        
+                        dataDict = formatL1NtupleObjects(muons, egammas, jets, energysums)
+                        bits = readL1NtupleBits(L1bittree, prescale_table, entry_start = report.tree_entry_start, entry_stop = report.tree_entry_stop,
+                                                bitIndexFromPrescale = bitIndexFromPrescale)
+                        
+                        stage.nBytes = file.file.source.num_requested_bytes - nBytes
+                    
+                    if(verbosity > 1): print("Read chunk %i (file %i/%i, events %i to %i)." % (iChunk, iFile+1, len(filepaths), report.tree_entry_start, report.tree_entry_stop))
+                    yield chunkInfoDict(infoDict, filepath, iChunk, report, len(dataDict["muons"]), moreInfo = moreInfo), dataDict, bits
+                    iChunk += 1
+    finally:
+        # the decompression threads would otherwise stay alive
+        if decompression_executor: decompression_executor.shutdown()
     
-    # after everything else: add moreInfo
-    if moreInfo: infoDict = {**infoDict, **moreInfo}
-        
     if(verbosity > 0): print("Done!")
-        
-    # we'll output the data as a dict, makes it easier later
+
+
+# NanoAOD: we only read the L1 objects and the L1_* bits from the Events tree
+# the L1 object branches and the names of the fields we use for them
+NanoAOD_branches = {
+    "muons": ("L1Mu_", {"pt": "pt", "eta": "eta", "phi": "phi"}),
+    "egammas": ("L1EG_", {"pt": "pt", "eta": "eta", "phi": "phi"}),
+    "jets": ("L1Jet_", {"pt": "pt", "eta": "eta", "phi": "phi"}),
+    "energysums": ("L1EtSum_", {"pt": "pt", "phi": "phi", "etSumType": "Type"}),
+}
+
+def getNanoAODFiles(inputpath):
+    # inputpath can be a list of files, a directory, a glob pattern or a single file
+    if not isinstance(inputpath, str): return list(inputpath)
+    if os.path.isdir(inputpath): return sorted(glob(inputpath + "/*.root"))
+    return sorted(glob(inputpath))
+
+def getNanoAODBitBranches(tree, prescale_table=None):
+    # all L1_* bits in the file, or only the un-prescaled ones if a prescale table is given
+    bit_branches = tree.keys(filter_name = "L1_*")
+    if prescale_table is not None: bit_branches = [branch for branch in bit_branches if branch in prescale_table]
+    return bit_branches
+
+def formatNanoAODArrays(arrays, bit_branches):
+    # converts the arrays read from NanoAOD into the dataDict and the L1 bits dataframe
     dataDict = {}
-    dataDict["muons"] = muons
-    dataDict["egammas"] = egammas
-    dataDict["jets"] = jets
-    dataDict["energysums"] = energysums
+    for collection, (prefix, fields) in NanoAOD_branches.items():
+        with_name = None if collection == "energysums" else "Momentum4D"
+        dataDict[collection] = ak.zip({name:arrays[prefix + field] for field, name in fields.items()}, with_name = with_name)
     
-    return infoDict, dataDict, bits
+    labels = list(bit_branches)
+    bit_matrix = np.empty( (len(arrays), len(labels)), dtype=bool )
+    for i, label in enumerate(labels): bit_matrix[:,i] = ak.to_numpy(arrays[label])
+    
+    # the total L1 bit is the OR of all used seeds
+    df_bits = pd.DataFrame(bit_matrix, columns=labels)
+    df_bits.insert(0, "total L1", bit_matrix.any(axis=1))
+    
+    return dataDict, df_bits
+
+@instrumentation.instrument(events = lambda result: len(result[1]))
+def readNanoAODFile(filepath, prescale_table=None, treeName="Events"):
+    # reads the L1 objects and bits of a single NanoAOD file, only touching the needed branches
+    # this is a module level function so that it can be sent to worker processes
+    with uproot.open(filepath) as file:
+        tree = file[treeName]
+        bit_branches = getNanoAODBitBranches(tree, prescale_table)
+        object_branches = [prefix + field for prefix, fields in NanoAOD_branches.values() for field in fields]
+        arrays = tree.arrays(filter_name = object_branches + bit_branches)
+        instrumentation.addBytes(file.file.source.num_requested_bytes)
+    
+    return formatNanoAODArrays(arrays, bit_branches)
+
 
+@instrumentation.instrument(events = lambda result: result[0]["nEvents"])
+def readFromNanoAOD(inputpath, prescale_file_name=None, treeName="Events", moreInfo=None, nWorkers=1, useThreads=False, cache_dir=None, verbosity=0):
+    # inputpath can be a directory containing the root files, a glob pattern, a single file or a list of files
+    # if a prescale file is given, only the un-prescaled L1 seeds are used (as for the L1 ntuples), otherwise all L1_* bits
+    # nWorkers, useThreads and cache_dir work as in readFromL1Ntuple
+    
+    if(verbosity > 0): print("Reading from NanoAOD in " + str(inputpath) + ".")
+    
+    # constructing the information dict
+    # some things will be automatically filled here
+    # the input "moreInfo" can be used to pass more information
+    # this information will have priority over automatically set entries
+    infoDict = {}
+    infoDict["input"] = inputpath if isinstance(inputpath, str) else list(inputpath)
+    infoDict["eventtree"] = treeName
+    
+    filepaths = getNanoAODFiles(inputpath)
+    if(verbosity > 0): print("Found %i files." % len(filepaths))
+    infoDict["nFiles"] = len(filepaths)
+    
+    cache_key = getCacheKey(filepaths + ([prescale_file_name] if prescale_file_name else []), "NanoAOD", infoDict["input"], treeName) if cache_dir else None
+    if cache_dir:
+        cached = readCached(cache_dir, cache_key, moreInfo = moreInfo, verbosity = verbosity)
+        if cached: return cached
+    
+    prescale_table = loadPrescaleTable(prescale_file_name) if prescale_file_name else None
+    
+    if(verbosity > 0): print("Starting to read objects and L1 trigger bits...")
+    
+    readFile = partial(readNanoAODFile, prescale_table = prescale_table, treeName = treeName)
+    results = readFiles(readFile, filepaths, nWorkers = nWorkers, useThreads = useThreads, verbosity = verbosity)
+    
+    dataDict = {collection:ak.concatenate([result[0][collection] for result in results], axis = 0) for collection in NanoAOD_branches}
+    bits = pd.concat([result[1] for result in results])
+    del results
+    
+    return finishDataset(infoDict, dataDict, bits, moreInfo = moreInfo, cache_dir = cache_dir, cache_key = cache_key, verbosity = verbosity)
 
-def readFromNanoAOD(inputpath):
-    # TODO: implement
-    # this most likely will specify an input path where multiple root files are located
-    # we could also use some xml file containing info on the files to load instead
 
-    raise Exception("readFromNanoAOD is not implemented yet!")
\ No newline at end of file
+def iterateNanoAOD(inputpath, prescale_file_name=None, step_size=100000, treeName="Events", moreInfo=None, nWorkers=1, verbosity=0):
+    # streaming version of readFromNanoAOD, yields (infoDict, dataDict, bits) for chunks of at most step_size events
+    # as for iterateL1Ntuple, nWorkers > 1 parallelizes the decompression within each chunk
+    
+    if(verbosity > 0): print("Iterating over NanoAOD in " + str(inputpath) + " in chunks of " + str(step_size) + " events.")
+    
+    filepaths = getNanoAODFiles(inputpath)
+    if(verbosity > 0): print("Found %i files." % len(filepaths))
+    
+    # the entries that are the same for all chunks
+    infoDict = {}
+    infoDict["input"] = inputpath if isinstance(inputpath, str) else list(inputpath)
+    infoDict["eventtree"] = treeName
+    infoDict["nFiles"] = len(filepaths)
+    
+    prescale_table = loadPrescaleTable(prescale_file_name) if prescale_file_name else None
+    object_branches = [prefix + field for prefix, fields in NanoAOD_branches.values() for field in fields]
+    decompression_executor = uproot.ThreadPoolExecutor(max_workers = nWorkers) if nWorkers > 1 else None
+    
+    iChunk = 0
+    try:
+        for iFile, filepath in enumerate(filepaths):
+            with uproot.open(filepath) as file:
+                tree = file[treeName]
+                bit_branches = getNanoAODBitBranches(tree, prescale_table)
+                
+                for arrays, report in iterateTree(file, tree, object_branches + bit_branches, step_size, "readNanoAODChunk",
+                                                  firstChunk = iChunk, decompression_executor = decompression_executor):
+                    
+                    with instrumentation.stage("formatNanoAODChunk", chunk = iChunk, nEvents = len(arrays)):
+                        dataDict, bits = formatNanoAODArrays(arrays, bit_branches)
+                    
+                    if(verbosity > 1): print("Read chunk %i (file %i/%i, events %i to %i)." % (iChunk, iFile+1, len(filepaths), report.tree_entry_start, report.tree_entry_stop))
+                    yield chunkInfoDict(infoDict, filepath, iChunk, report, len(dataDict["muons"]), moreInfo = moreInfo), dataDict, bits
+                    iChunk += 1
+    finally:
+        # the decompression threads would otherwise stay alive
+        if decompression_executor: decompression_executor.shutdown()
+    
+    if(verbosity > 0): print("Done!")
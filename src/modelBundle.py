@@ -0,0 +1,115 @@
+import os
+import pickle
+from collections import OrderedDict
+from numpyModel import loadNumpyModel
+
+# Everything that belongs to a model directory, loaded once and kept in memory:
+# - the info dict (network_info.pkl)
+# - the scalers of all folds (scaler_foldX.pkl)
+# - the models of all folds (model_foldX.h5), loaded on first use
+#
+# prepareData and runInference accept a ModelBundle instead of a path, so repeated calls
+# (many thresholds, datasets or chunks) do not have to load anything from disk again.
+# Use loadModelBundle to get one, it keeps the last bundles in an in-process cache.
+#
+# The backend decides how the models are evaluated:
+# - "keras": keras.models.load_model (imports tensorflow on first use)
+# - "numpy": numpyModel.NumpyDenseModel, reads the dense layers from the .h5 file and evaluates them
+#   with numpy matmuls, without importing keras or tensorflow at all
+
+class ModelBundle:
+
+    def __init__(self, model_dir, backend = "keras", verbosity = 0):
+
+        if(verbosity > 0): print("Loading model bundle from " + model_dir + "...")
+        self.model_dir = model_dir
+        self.backend = backend
+        self.verbosity = verbosity
+
+        with open(os.path.join(model_dir, 'network_info.pkl'), 'rb') as f:
+            self.infoDict = pickle.load(f)
+
+        # we'll determine the number of scalers from the infoDict (see folds)
+        # scalers[i] always belongs to fold i: they are required for topo models, while for anomaly
+        # detection models they are optional (None for a fold without scaler)
+        self.scalers = []
+        for i in range(self.folds):
+            scaler_file = os.path.join(model_dir, "scaler_fold" + str(i) + ".pkl")
+            if not os.path.exists(scaler_file):
+                if self.infoDict.get("type") != "anomaly": raise Exception("Scaler " + scaler_file + " not found.")
+                self.scalers.append(None)
+                continue
+            with open(scaler_file, 'rb') as inp: self.scalers.append( pickle.load(inp) )
+
+        # the models are only loaded when needed, loading them (and tensorflow) can take a while
+        self.models = {}
+
+    @property
+    def folds(self):
+        return self.infoDict.get("folds", 1)
+
+    def modelFile(self, fold = 0):
+        return os.path.join(self.model_dir, "model_fold" + str(fold) + ".h5")
+
+    def getModel(self, fold = 0):
+        if fold not in self.models:
+            self.models[fold] = loadModel(self.modelFile(fold), backend = self.backend, verbosity = self.verbosity)
+        return self.models[fold]
+
+    def getModels(self):
+        return [self.getModel(fold) for fold in range(self.folds)]
+
+
+# the in-process cache: the key contains the modification times of all files in the model dir,
+# so a retrained model is picked up automatically
+bundle_cache = OrderedDict()
+bundle_cache_size = 8
+
+def modelDirKey(model_dir):
+    files = sorted(os.listdir(model_dir))
+    return (os.path.abspath(model_dir),) + tuple( (f, os.stat(os.path.join(model_dir, f)).st_mtime_ns) for f in files )
+
+def loadModelBundle(model_dir, backend = "keras", verbosity = 0):
+    key = modelDirKey(model_dir) + (backend,)
+
+    if key in bundle_cache:
+        bundle_cache.move_to_end(key)
+        return bundle_cache[key]
+
+    bundle = ModelBundle(model_dir, backend = backend, verbosity = verbosity)
+    bundle_cache[key] = bundle
+    if len(bundle_cache) > bundle_cache_size: bundle_cache.popitem(last = False)
+
+    return bundle
+
+def getModelBundle(model, backend = "keras", verbosity = 0):
+    # helper for functions that accept either a model dir or a ModelBundle
+    if isinstance(model, ModelBundle): return model
+    return loadModelBundle(model, backend = backend, verbosity = verbosity)
+
+
+# same for single model files, for the case that runInference is called with a path
+model_cache = OrderedDict()
+model_cache_size = 8
+
+def loadModel(model_file, backend = "keras", verbosity = 0):
+    key = (os.path.abspath(model_file), os.stat(model_file).st_mtime_ns, backend)
+
+    if key in model_cache:
+        model_cache.move_to_end(key)
+        return model_cache[key]
+
+    if(verbosity > 0): print("Loading model from " + str(model_file) + " for the " + backend + " backend...")
+    if backend == "keras":
+        # importing keras only here, as it takes a few seconds
+        import keras
+        model = keras.models.load_model(model_file)
+    elif backend == "numpy":
+        model = loadNumpyModel(model_file)
+    else:
+        raise Exception("Backend " + backend + " not recognized.")
+
+    model_cache[key] = model
+    if len(model_cache) > model_cache_size: model_cache.popitem(last = False)
+
+    return model
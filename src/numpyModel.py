@@ -0,0 +1,161 @@
+import json
+import h5py
+import numpy as np
+
+# A lightweight inference backend for our (small, dense) networks, using only numpy.
+# The weights are read directly from the keras .h5 files with h5py, so neither keras nor tensorflow
+# have to be imported. Alternatively, exportDenseWeights can be used to store the weights as plain
+# numpy arrays (.npz).
+#
+# Supported layers: InputLayer, Dense, Dropout, Activation, ReLU, LeakyReLU, BatchNormalization, Flatten
+# Only sequential models (or functional models that are a simple chain of layers) are supported.
+
+activations = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    # sigmoid(x) = exp(-log(1 + exp(-x))), which does not overflow for large negative x
+    "sigmoid": lambda x: np.exp(-np.logaddexp(0, -x)),
+    "tanh": np.tanh,
+    "elu": lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    "selu": lambda x: 1.0507009873554805 * np.where(x > 0, x, 1.6732632423543772 * np.expm1(np.minimum(x, 0))),
+    "softplus": lambda x: np.logaddexp(x, 0),
+    "swish": lambda x: x * np.exp(-np.logaddexp(0, -x)),
+    "silu": lambda x: x * np.exp(-np.logaddexp(0, -x)),
+    "softmax": lambda x: np.exp(x - x.max(axis=-1, keepdims=True)) / np.exp(x - x.max(axis=-1, keepdims=True)).sum(axis=-1, keepdims=True),
+}
+
+def activationName(activation):
+    # newer keras versions can store activations as serialized objects instead of names
+    if isinstance(activation, dict):
+        config = activation.get("config")
+        return config.get("name") if isinstance(config, dict) else config
+    return activation
+
+def getActivation(name):
+    if name not in activations: raise Exception("Activation " + str(name) + " is not supported by the numpy backend.")
+    return activations[name]
+
+
+class NumpyDenseModel:
+    # layers is a list of (type, parameters) tuples, with
+    # - ("dense", {"kernel": ..., "bias": ..., "activation": ...})
+    # - ("activation", {"activation": ...})
+    # - ("leakyrelu", {"alpha": ...})
+    # - ("batchnorm", {"scale": ..., "offset": ...}), already folded from gamma, beta, mean and variance
+    # - ("flatten", {})
+
+    def __init__(self, layers, dtype = np.float32):
+        self.layers = layers
+        self.dtype = dtype
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype = self.dtype)
+        for layer_type, parameters in self.layers:
+            if layer_type == "dense":
+                x = x @ parameters["kernel"]
+                if parameters["bias"] is not None: x += parameters["bias"]
+                x = getActivation(parameters["activation"])(x)
+            elif layer_type == "activation":
+                x = getActivation(parameters["activation"])(x)
+            elif layer_type == "leakyrelu":
+                x = np.where(x > 0, x, parameters["alpha"] * x)
+            elif layer_type == "batchnorm":
+                x = x * parameters["scale"] + parameters["offset"]
+            elif layer_type == "flatten":
+                x = x.reshape(len(x), -1)
+        return x
+
+    # same interface as keras, so that it can be used everywhere a keras model is used for inference
+    def predict(self, x, batch_size = 10000, verbose = 0):
+        if len(x) == 0: return self.predict_on_batch(x)
+        return np.concatenate([self.predict_on_batch(x[start:start + batch_size]) for start in range(0, len(x), batch_size)])
+
+    def __call__(self, x, training = False):
+        return self.predict_on_batch(x)
+
+
+def readLayerWeights(weights_group, layer_name):
+    # returns a dict of the weights of a layer in a keras .h5 file, with the short names (kernel, bias, gamma...) as keys
+    if layer_name not in weights_group: return {}
+    layer_group = weights_group[layer_name]
+
+    weights = {}
+    for weight_name in layer_group.attrs.get("weight_names", []):
+        if isinstance(weight_name, bytes): weight_name = weight_name.decode()
+        short_name = weight_name.split("/")[-1].split(":")[0]
+        weights[short_name] = np.asarray(layer_group[weight_name])
+    return weights
+
+
+def readKerasH5(model_file, dtype = np.float32):
+    # converts a keras .h5 model file to the list of layers of a NumpyDenseModel
+    with h5py.File(model_file, 'r') as f:
+        model_config = f.attrs["model_config"]
+        if isinstance(model_config, bytes): model_config = model_config.decode()
+        model_config = json.loads(model_config)
+
+        # the layer list is stored differently depending on the keras version
+        layer_configs = model_config["config"]
+        if isinstance(layer_configs, dict): layer_configs = layer_configs["layers"]
+
+        weights_group = f["model_weights"] if "model_weights" in f else f
+
+        layers = []
+        for layer_config in layer_configs:
+            class_name = layer_config["class_name"]
+            config = layer_config["config"]
+            weights = readLayerWeights(weights_group, config["name"])
+
+            if class_name in ["InputLayer", "Dropout", "GaussianNoise", "GaussianDropout", "AlphaDropout"]:
+                # nothing to do at inference time
+                continue
+            elif class_name == "Dense":
+                layers.append( ("dense", {"kernel": weights["kernel"].astype(dtype), "bias": weights["bias"].astype(dtype) if "bias" in weights else None, "activation": activationName(config.get("activation", "linear"))}) )
+            elif class_name == "Activation":
+                layers.append( ("activation", {"activation": activationName(config["activation"])}) )
+            elif class_name == "ReLU":
+                layers.append( ("activation", {"activation": "relu"}) )
+            elif class_name == "LeakyReLU":
+                layers.append( ("leakyrelu", {"alpha": config.get("negative_slope", config.get("alpha", 0.3))}) )
+            elif class_name == "BatchNormalization":
+                # folding the normalization into a single scale and offset
+                scale = weights.get("gamma", 1) / np.sqrt(weights["moving_variance"] + config.get("epsilon", 1e-3))
+                offset = weights.get("beta", 0) - weights["moving_mean"] * scale
+                layers.append( ("batchnorm", {"scale": np.asarray(scale, dtype=dtype), "offset": np.asarray(offset, dtype=dtype)}) )
+            elif class_name == "Flatten":
+                layers.append( ("flatten", {}) )
+            else:
+                raise Exception("Layer " + class_name + " is not supported by the numpy backend.")
+
+    return layers
+
+
+def exportDenseWeights(model_file, output_file):
+    # stores the layers of a keras .h5 model as plain numpy arrays (.npz)
+    layers = readKerasH5(model_file)
+
+    arrays = {"layer_types": np.array([layer_type for layer_type, _ in layers])}
+    for i, (layer_type, parameters) in enumerate(layers):
+        for key, value in parameters.items():
+            if value is None: continue
+            arrays["layer%i_%s" % (i, key)] = np.asarray(value)
+    np.savez(output_file, **arrays)
+
+
+def loadNumpyModel(model_file, dtype = np.float32):
+    # loads a model for the numpy backend, either from a keras .h5 file or from the output of exportDenseWeights
+    if not model_file.endswith(".npz"): return NumpyDenseModel(readKerasH5(model_file, dtype = dtype), dtype = dtype)
+
+    with np.load(model_file) as arrays:
+        layers = []
+        for i, layer_type in enumerate(arrays["layer_types"]):
+            prefix = "layer%i_" % i
+            parameters = {key[len(prefix):]:arrays[key] for key in arrays.files if key.startswith(prefix)}
+            for key, value in parameters.items():
+                if value.dtype.kind in "US": parameters[key] = str(value)
+                elif value.ndim == 0: parameters[key] = value.item()
+                else: parameters[key] = value.astype(dtype)
+            if layer_type == "dense" and "bias" not in parameters: parameters["bias"] = None
+            layers.append( (str(layer_type), parameters) )
+
+    return NumpyDenseModel(layers, dtype = dtype)
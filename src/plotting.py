@@ -1,8 +1,10 @@
+import json
 import numpy as np
 import awkward as ak
 import matplotlib
 import matplotlib.pyplot as plt
 import mplhep as hep
+import instrumentation
 plt.style.use(hep.style.ROOT)
 
 # a collection of plotting functions
@@ -16,46 +18,158 @@ def totalMinBiasRate():
     return LHCfreq * nCollBunch / 1e3 # in kHz
 
 
-# a plotting function for one parameter of one object before and after the trigger application
-# only doing leading one for this quick test
-def plotSculpting(data, triggerBit):
+# histogram accumulators with a fixed binning, that can be filled chunk by chunk
+# they can be summed (e.g. over files or workers) with + and stored as json, the plotting functions
+# below can render them instead of raw arrays
+
+class HistAccumulator:
+    
+    def __init__(self, bins = 10, interval = None, label = None):
+        # bins: either the bin edges, or the number of bins in the given interval
+        if np.ndim(bins) == 0:
+            if interval is None: raise Exception("A fixed binning needs an interval if only the number of bins is given.")
+            bins = np.linspace(interval[0], interval[1], bins + 1)
+        self.edges = np.asarray(bins, dtype=float)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=float)
+        self.label = label
+        self.nEntries = 0
+    
+    def fill(self, values, weights = None):
+        values = np.asarray(values).ravel()
+        self.counts += np.histogram(values, self.edges, weights = weights)[0]
+        self.nEntries += len(values)
+        return self
     
-    assert(len(data) == len(triggerBit))
+    def values(self, density = False):
+        # same normalization as np.histogram(..., density = True)
+        if density: return self.counts / max(self.counts.sum(), 1) / np.diff(self.edges)
+        return self.counts
     
-    # first, get data before and after trigger bit
-    np_data_beforeBit = ak.flatten( data ).to_numpy()
-    np_triggerBit = triggerBit.to_numpy().flatten()
-    np_data_afterBit = ak.flatten( data[np_triggerBit] ).to_numpy()
+    def __add__(self, other):
+        if not np.array_equal(self.edges, other.edges): raise Exception("Cannot add histograms with different binnings.")
+        result = HistAccumulator(self.edges, label = self.label)
+        result.counts = self.counts + other.counts
+        result.nEntries = self.nEntries + other.nEntries
+        return result
     
-    # creating histograms
-    before_hist, bins = np.histogram( np_data_beforeBit )
-    after_hist, bins = np.histogram( np_data_afterBit, bins=bins )
+    def toDict(self):
+        return {"edges": self.edges.tolist(), "counts": self.counts.tolist(), "label": self.label, "nEntries": self.nEntries}
+    
+    @classmethod
+    def fromDict(cls, histDict):
+        hist = cls(histDict["edges"], label = histDict.get("label"))
+        hist.counts = np.asarray(histDict["counts"], dtype=float)
+        hist.nEntries = histDict.get("nEntries", 0)
+        return hist
+    
+    def save(self, filename):
+        with open(filename, "w") as f: json.dump(self.toDict(), f)
+    
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f: return cls.fromDict(json.load(f))
+
+
+def selectObjectValues(data, index = None, eventMask = None):
+    # returns the values of all objects (index = None) or of the index-th leading object of each event as numpy array
+    # if eventMask is given, only objects of the selected events are returned
+    if index is not None:
+        column = ak.pad_none(data, index + 1, clip = True, axis = 1)[:, index]
+        present = ~ak.to_numpy(ak.is_none(column))
+        if eventMask is not None: present &= eventMask
+        return ak.to_numpy(ak.fill_none(column, 0))[present]
+    
+    values = ak.to_numpy(ak.flatten(data, axis = 1))
+    if eventMask is None: return values
+    # selecting the objects of the selected events on the flat array, instead of slicing the awkward array
+    return values[np.repeat(eventMask, ak.to_numpy(ak.num(data, axis = 1)))]
+
+
+class SculptingAccumulator:
+    # histograms of one object variable before and after a trigger bit
+    # index: only use the index-th leading object of each event (None: all objects)
+    
+    def __init__(self, bins = 10, interval = None, index = None, label = None):
+        self.index = index
+        self.label = label
+        self.before = HistAccumulator(bins, interval, label = "before trigger")
+        self.after = HistAccumulator(self.before.edges, label = "after trigger")
+    
+    @instrumentation.instrument("SculptingAccumulator.fill")
+    def fill(self, data, triggerBit):
+        assert(len(data) == len(triggerBit))
+        instrumentation.addEvents(len(data))
+        np_triggerBit = np.asarray(triggerBit).flatten().astype(bool)
+        
+        self.before.fill( selectObjectValues(data, self.index) )
+        self.after.fill( selectObjectValues(data, self.index, np_triggerBit) )
+        return self
+    
+    def __add__(self, other):
+        if self.index != other.index: raise Exception("Cannot add sculpting histograms for different objects.")
+        result = SculptingAccumulator(self.before.edges, index = self.index, label = self.label)
+        result.before = self.before + other.before
+        result.after = self.after + other.after
+        return result
+    
+    def toDict(self):
+        return {"index": self.index, "label": self.label, "before": self.before.toDict(), "after": self.after.toDict()}
+    
+    @classmethod
+    def fromDict(cls, sculptingDict):
+        sculpting = cls(sculptingDict["before"]["edges"], index = sculptingDict["index"], label = sculptingDict.get("label"))
+        sculpting.before = HistAccumulator.fromDict(sculptingDict["before"])
+        sculpting.after = HistAccumulator.fromDict(sculptingDict["after"])
+        return sculpting
+    
+    def save(self, filename):
+        with open(filename, "w") as f: json.dump(self.toDict(), f)
+    
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f: return cls.fromDict(json.load(f))
+
+
+# a plotting function for one parameter of one object before and after the trigger application
+# data can also be a SculptingAccumulator, which is then plotted directly
+@instrumentation.instrument()
+def plotSculpting(data, triggerBit = None, bins = 10, interval = None, index = None):
+    
+    if not isinstance(data, SculptingAccumulator):
+        # determining the binning from the full data, as np.histogram does
+        if interval is None and np.ndim(bins) == 0:
+            values = selectObjectValues(data, index)
+            interval = (values.min(), values.max()) if len(values) > 0 else (0, 1)
+        data = SculptingAccumulator(bins, interval, index = index).fill(data, triggerBit)
     
     # plotting
-    hep.histplot(before_hist, bins)
-    hep.histplot(after_hist, bins)
+    hep.histplot(data.before.counts, data.before.edges)
+    hep.histplot(data.after.counts, data.after.edges)
     
     plt.yscale("log")
     
+    return data
+    
+@instrumentation.instrument()
 def plot_hist(data, ax = None, bins = 10, interval = None, logy = False, logx = False,
               info = None, density = False, index = None):
 ## Die Funktion kann Histogramme plotten wo eigenes Binning und Density angegeben werden kann. 
 ## Ausserdem koennen mehrere Plots in eine Figure gemacht werden und die Achsen logarithmisch gemacht werden
+## data kann auch ein HistAccumulator sein, dann wird dieser direkt geplottet
     if ax == None:
         fig, ax = plt.subplots()
         print("new axis is defined")
     if info == None:
         info = {"input" : "There is no further Information"}
-        
-    #Suche ein bestimmtes Teilchen aus und konvertiere die Awkward Arrays to Numpy Arrays
-    if index != None:    
-        new_data = ak.pad_none(data, index+1, clip = True, axis = 1) 
-        new_data = new_data[ : ,index].to_numpy()
-    else:
-        new_data = ak.flatten(data).to_numpy()
     
-    #Create a Histogram
-    hist, hist_edges = np.histogram(new_data, bins, interval, density = density)
+    if isinstance(data, HistAccumulator):
+        hist, hist_edges = data.values(density), data.edges
+    else:
+        #Suche ein bestimmtes Teilchen aus und konvertiere die Awkward Arrays to Numpy Arrays
+        new_data = selectObjectValues(data, index)
+        
+        #Create a Histogram
+        hist, hist_edges = np.histogram(new_data, bins, interval, density = density)
     interval = (hist_edges[0],hist_edges[-1])
     
     #plot Histogram
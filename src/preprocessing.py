@@ -1,64 +1,141 @@
 import numpy as np
 import awkward as ak
-import pickle
+from modelBundle import getModelBundle
+from loadData import anomaly_slices
+import instrumentation
 
 # Functions for data preprocessing.
 # prepareData is the main function, which determines from the passed model what kind of preparation is needed
 
-def prepareData(model_dir, data, verbosity = 0):
+@instrumentation.instrument(events = len)
+def prepareData(model_dir, data, scale = True, verbosity = 0):
     # Expected input:
     # - a model. I would propose just passing a path to a directory containing all info
+    #   (or a ModelBundle from modelBundle.loadModelBundle, which avoids reloading anything from disk)
     # - data_*: this can be anything the concrete method needs, stored in a dict (or list, or array...)
     #
     # Expected output:
     # - NN input variables (x_test), numpy array
+    #   with scale = False, the scalers are not applied (e.g. for inference.runBatchedInference,
+    #   which applies the scaler of each fold batch by batch)
 
     # Implementation: determine from the info in model_dir what kind of model is needed
     # Then call one of the specialized functions from below
 
     # loading the info dict to determine the model type
-    with open(model_dir+'network_info.pkl', 'rb') as f:
-        infoDict = pickle.load(f)
+    # (the bundles are cached, so this only reads from disk the first time)
+    bundle = getModelBundle(model_dir, verbosity = verbosity)
+    infoDict = bundle.infoDict
     
     if(verbosity > 0): print("Preparing data for type " + infoDict["type"] + "...")
     if(infoDict["type"] == "topo"):
-        return prepareDataTopotrigger(model_dir, data, verbosity = verbosity)
+        return prepareDataTopotrigger(bundle, data, scale = scale, verbosity = verbosity)
+    elif(infoDict["type"] == "anomaly"):
+        return prepareDataAnomaly(bundle, data, scale = scale, verbosity = verbosity)
     else:
         raise Exception("Model type " + infoDict["type"] + " is not yet implemented.")
         
 
 # we could also import these from somewhere, if we want to keep the model-dependent parts separated
 
-def awkward_to_numpy(ak_array, maxN):
-    # this is a bit ugly, but it works. Maybe we can improve later
-    selected_arr = ak.fill_none( ak.pad_none( ak_array, maxN, clip=True, axis=-1), {"pt":0, "eta":0, "phi":0})
-    np_arr = np.stack( (selected_arr.pt.to_numpy(), selected_arr.eta.to_numpy(), selected_arr.phi.to_numpy()), axis=2)
-    return np_arr.reshape(np_arr.shape[0], np_arr.shape[1] * np_arr.shape[2])
+def awkward_to_numpy(ak_array, maxN, out=None):
+    # converts the pt, eta and phi of the first maxN objects to a (N, maxN*3) numpy array (pt, eta, phi, pt, ...)
+    # missing objects are filled with zeros
+    # if out is given, the result is written into it (e.g. a column block of a bigger array) instead
+    # of allocating a new array
+    if out is None: out = np.empty( (len(ak_array), maxN * 3), dtype=np.float32 )
+    
+    # instead of padding the awkward array (which creates an index array of size N*maxN, plus copies per field),
+    # we fill the output object slot by object slot from the flat object arrays
+    counts = ak.to_numpy( ak.num(ak_array, axis=1) )
+    starts = np.cumsum(counts) - counts
+    flat_fields = [ak.to_numpy( ak.flatten(ak_array[field], axis=1) ) for field in ["pt", "eta", "phi"]]
+    
+    out[:] = 0
+    for j in range(maxN):
+        events = np.nonzero(counts > j)[0]
+        object_index = starts[events] + j
+        for i, flat_field in enumerate(flat_fields):
+            out[events, 3*j + i] = flat_field[object_index]
+    return out
 
-def formatDataTopotrigger(infoDict, data, verbosity = 0):
+def dense_to_numpy(np_array, maxN, out=None):
+    # the dense equivalent of awkward_to_numpy: np_array is a (N, nObjects, 3) array of (pt, eta, phi)
+    # where empty objects have pt = 0. As in the awkward version, empty objects are removed and the
+    # remaining ones are padded with zeros (or clipped) to maxN
+    if out is None: out = np.empty( (np_array.shape[0], maxN * 3), dtype=np.float32 )
+    
+    valid = np_array[:,:,0] > 0
+    
+    # empty objects are usually only at the end; if not, move the valid ones to the front (keeping their order)
+    if np.any( valid[:,1:] & ~valid[:,:-1] ):
+        order = np.argsort(~valid, axis=1, kind="stable")
+        np_array = np.take_along_axis(np_array, order[:,:,None], axis=1)
+        valid = np.take_along_axis(valid, order, axis=1)
+    
+    nSlots = min(maxN, np_array.shape[1])
+    for i in range(3):
+        out[:, i:3*nSlots:3] = np.where( valid[:,:nSlots], np_array[:,:nSlots,i], 0 )
+    out[:, 3*nSlots:] = 0
+    return out
+
+def topoInputBlocks(infoDict):
+    # the column ranges of the objects in the topo trigger input matrix
+    # important! topo trigger networks will always used the following order of inputs:
+    # energy sums (MET, MET phi), jets, muons, egammas
+    blocks = {}
+    start = 2
+    for collection, nKey in [("jets", "nJets"), ("muons", "nMuons"), ("egammas", "nEgammas")]:
+        blocks[collection] = (start, start + 3 * infoDict[nKey], infoDict[nKey])
+        start += 3 * infoDict[nKey]
+    return blocks, start
+
+def formatDenseTopotrigger(infoDict, dense, dtype = np.float32, verbosity = 0):
+    # fast path of formatDataTopotrigger for inputs that are dense already (anomaly team h5s)
+    # this gives the same output, but skips the conversion to awkward and back
+    
+    if(verbosity > 1): print("Formating dense data for topo trigger usage...")
+    
+    blocks, nColumns = topoInputBlocks(infoDict)
+    x_test = np.empty( (len(dense["energysums"]), nColumns), dtype=dtype )
+    
+    # MET is the only energy sum here, stored as (pt, 0, phi)
+    x_test[:,0] = dense["energysums"][:,0,0]
+    x_test[:,1] = dense["energysums"][:,0,2]
+    
+    for collection, (start, stop, maxN) in blocks.items():
+        dense_to_numpy(dense[collection], maxN, out = x_test[:,start:stop])
+    
+    return x_test
+
+def formatDataTopotrigger(infoDict, data, dtype = np.float32, verbosity = 0):
     # a helper function for the topo trigger that x_test outputs data in the desired format
+    # everything is written into a single preallocated array, column block by column block
+    
+    # using the fast path if the readers provided the dense arrays
+    dense = getattr(data, "dense", None)
+    if dense is not None: return formatDenseTopotrigger(infoDict, dense, dtype = dtype, verbosity = verbosity)
     
     if(verbosity > 1): print("Formating data for topo trigger usage...")
     
     energysums = data["energysums"]
-    jets = data["jets"]
-    muons = data["muons"]
-    egammas = data["egammas"]
     
-    # first, lets get MET and MET phi
-    np_MET = np.asarray( ak.to_numpy( energysums[energysums.Type == 2].pt).flatten() ).reshape( (len(energysums), 1) )
-    np_MET_phi = np.asarray( ak.to_numpy(energysums[energysums.Type == 2].phi).flatten() ).reshape( (len(energysums), 1) )
+    blocks, nColumns = topoInputBlocks(infoDict)
+    x_test = np.empty( (len(energysums), nColumns), dtype=dtype )
     
-    # now, lets add particles based on the info in the infoDict
-    np_jets = awkward_to_numpy(jets, infoDict["nJets"])
-    np_muons = awkward_to_numpy(muons, infoDict["nMuons"])
-    np_egammas = awkward_to_numpy(egammas, infoDict["nEgammas"])
+    # first, lets get MET and MET phi (we expect exactly one MET per event)
+    # the selection is done once, and only applied to the two fields we need
+    isMET = energysums.Type == 2
+    x_test[:,0] = ak.to_numpy( ak.flatten(energysums.pt[isMET]) )
+    x_test[:,1] = ak.to_numpy( ak.flatten(energysums.phi[isMET]) )
     
-    x_test = np.concatenate( (np_MET, np_MET_phi, np_jets, np_muons, np_egammas), axis=1 )
+    # now, lets add particles based on the info in the infoDict
+    for collection, (start, stop, maxN) in blocks.items():
+        awkward_to_numpy(data[collection], maxN, out = x_test[:,start:stop])
     
     return x_test
 
-def prepareDataTopotrigger(model_dir, data, verbosity = 0):
+def prepareDataTopotrigger(model_dir, data, scale = True, verbosity = 0):
     
     # the implementation for the topo trigger expects up to two dicts of ak arrays
     # containing the following keys: energysums, muons, egammas, jets
@@ -67,28 +144,79 @@ def prepareDataTopotrigger(model_dir, data, verbosity = 0):
     # each model has a scaler: scaler_foldX.pkl
     
     # the info dict will be used to store some more info on the desired input variables
-    with open(model_dir+'network_info.pkl', 'rb') as f:
-        infoDict = pickle.load(f)
+    bundle = getModelBundle(model_dir, verbosity = verbosity)
+    infoDict = bundle.infoDict
     
     # important! topo trigger networks will always used the following order of inputs:
     # energy sums, jets, muons, egammas
 
     # creating the x_test according to the info stored in the infoDict
     x = formatDataTopotrigger(infoDict, data, verbosity = verbosity)
+    if not scale: return x
             
     # finally, apply the StandardScaler to the test dataset
-    # first, load the scalers. We'll determine the number of scalers from the infoDics
-    scalers = []
-    for i in range(infoDict["folds"]):
-        with open(model_dir + "/scaler_fold" + str(i) + ".pkl", 'rb') as inp: scalers.append( pickle.load(inp) )
-     
-    x_scaled = []
-    for scaler in scalers: x_scaled.append( scaler.transform(x) )
-    
-    # only returning the first one for the moment, need to have discussion on kFold later
-    return x_scaled[0]
+    # only the scaler of the first fold is used for the moment, need to have discussion on kFold later
+    # (inference.runBatchedInference applies the scaler of each fold batch by batch to the unscaled inputs)
+    return bundle.scalers[0].transform(x)
+
+
+# the anomaly detection networks use the layout of the anomaly team data cubes, flattened:
+# MET (pt, 0, phi), 4 egammas, 4 muons, 10 jets, each (pt, eta, phi) -> 19*3 = 57 inputs
+# the number of objects can be changed via the infoDict (nEgammas, nMuons, nJets)
+anomaly_default_objects = {"egammas": 4, "muons": 4, "jets": 10}
 
+def anomalyInputBlocks(infoDict):
+    # the column ranges of the objects in the (flattened) anomaly detection input matrix
+    blocks = {}
+    start = 3
+    for collection, nKey in [("egammas", "nEgammas"), ("muons", "nMuons"), ("jets", "nJets")]:
+        maxN = infoDict.get(nKey, anomaly_default_objects[collection])
+        blocks[collection] = (start, start + 3 * maxN, maxN)
+        start += 3 * maxN
+    return blocks, start
 
-def prepareDataAnomaly(model_dir, data):
+def formatDataAnomaly(infoDict, data, dtype = np.float32, verbosity = 0):
+    # builds the (N, 57) anomaly detection inputs in a single preallocated array
+    # for the anomaly team h5s, the data cube is used directly instead of the awkward arrays
+    
+    blocks, nColumns = anomalyInputBlocks(infoDict)
+    
+    dense = getattr(data, "dense", None)
+    cube = dense.get("cube") if dense is not None else None
+    if cube is not None:
+        if(verbosity > 1): print("Formating dense data for anomaly detection usage...")
+        x_test = np.empty( (len(cube), nColumns), dtype=dtype )
+        x_test[:,0] = cube[:,0,0]
+        x_test[:,1] = 0
+        x_test[:,2] = cube[:,0,2]
+        for collection, (start, stop, maxN) in blocks.items():
+            dense_to_numpy(cube[:,anomaly_slices[collection],:], maxN, out = x_test[:,start:stop])
+        return x_test
+    
+    if(verbosity > 1): print("Formating data for anomaly detection usage...")
+    
+    energysums = data["energysums"]
+    x_test = np.empty( (len(energysums), nColumns), dtype=dtype )
+    
+    # MET, as in the data cubes stored as (pt, 0, phi)
+    isMET = energysums.Type == 2
+    x_test[:,0] = ak.to_numpy( ak.flatten(energysums.pt[isMET]) )
+    x_test[:,1] = 0
+    x_test[:,2] = ak.to_numpy( ak.flatten(energysums.phi[isMET]) )
+    
+    for collection, (start, stop, maxN) in blocks.items():
+        awkward_to_numpy(data[collection], maxN, out = x_test[:,start:stop])
+    
+    return x_test
 
-    raise Exception("prepareDataAnomaly is not implemented yet!")
\ No newline at end of file
+def prepareDataAnomaly(model_dir, data, scale = True, verbosity = 0):
+    
+    # same inputs as for the topo trigger (dicts of ak arrays, or the dense arrays of the anomaly team h5s)
+    # the scaler is optional here: if the model dir contains a scaler for the first fold, it is applied
+    # to the flattened inputs
+    bundle = getModelBundle(model_dir, verbosity = verbosity)
+    
+    x = formatDataAnomaly(bundle.infoDict, data, verbosity = verbosity)
+    if not scale or not bundle.scalers or bundle.scalers[0] is None: return x
+    
+    return bundle.scalers[0].transform(x)
@@ -0,0 +1,339 @@
+import os
+import json
+import queue
+import argparse
+import threading
+import h5py
+import numpy as np
+import pandas as pd
+
+from loadData import iterateL1Ntuple, iterateNanoAOD, LazyAnomalyh5
+from preprocessing import prepareData
+from inference import runBatchedScores, OverlapCounter
+from modelBundle import getModelBundle
+import instrumentation
+
+# End-to-end runner: read -> prepareData -> inference -> trigger bits / rates, over chunks of events.
+# The stages run in their own threads and are connected by bounded queues, so chunk n+1 is read while
+# chunk n is preprocessed and chunk n-1 is inferred, and never more than a few chunks are in memory.
+#
+# The dataset is given as a dict (or the path to a json file containing it):
+# - {"type": "L1Ntuple", "path": ..., "prescale": ...}
+# - {"type": "NanoAOD", "path": ..., "prescale": ...}  (prescale is optional here)
+# - {"type": "anomalyBackground", "path": ...}
+# - {"type": "anomalySignal", "path": ..., "process": ...}
+# further entries are passed on to the reader (e.g. eventTree for L1 ntuples)
+#
+# Outputs in output_dir:
+# - scores.h5: the scores ("scores"), the total L1 bit ("total L1") and one trigger bit per threshold
+# - rates.csv, overlap.csv, unique.csv: the rate summary and the overlap tables of the OverlapCounter
+# - run_info.json: the settings of the run and the number of processed events
+# if multiple models are compared, the scores and trigger bits of each model are stored in a group
+# named after the model, and the rate files get the model name as suffix (rates_<name>.csv, ...)
+#
+# usage from the command line:
+# python runner.py --dataset dataset.json --model-dir models/topo/ --output results/ --thresholds 0.99 0.999
+# python runner.py --dataset dataset.json --model-dir models/topoA/ models/topoB/ --output results/ --thresholds 0.99
+# with --profile trace.json, the time, events, bytes read and memory of every stage are recorded (see instrumentation.py)
+
+
+def loadDatasetSpec(dataset):
+    if isinstance(dataset, str):
+        with open(dataset) as f: dataset = json.load(f)
+    return dict(dataset)
+
+
+def iterateDataset(dataset, step_size = 100000, nWorkers = 1, verbosity = 0):
+    # yields (infoDict, dataDict, bits) chunks for any of the supported dataset types
+    dataset = loadDatasetSpec(dataset)
+    dataset_type = dataset.pop("type")
+    path = dataset.pop("path")
+
+    if dataset_type == "L1Ntuple":
+        prescale = dataset.pop("prescale")
+        yield from iterateL1Ntuple(path, prescale, step_size = step_size, nWorkers = nWorkers, verbosity = verbosity, **dataset)
+    elif dataset_type == "NanoAOD":
+        prescale = dataset.pop("prescale", None)
+        yield from iterateNanoAOD(path, prescale, step_size = step_size, nWorkers = nWorkers, verbosity = verbosity, **dataset)
+    elif dataset_type in ["anomalyBackground", "anomalySignal"]:
+        process = dataset.pop("process", None)
+        with LazyAnomalyh5(path, process = process, verbosity = verbosity, **dataset) as reader:
+            yield from reader.iterate(step_size = step_size)
+    else:
+        raise Exception("Dataset type " + dataset_type + " not recognized.")
+
+
+# comparing multiple models: the NN inputs only depend on the model type and the number of objects,
+# so they are built once per chunk for all models that share them
+def inputSpec(bundle):
+    infoDict = bundle.infoDict
+    return (infoDict["type"], infoDict.get("nJets"), infoDict.get("nMuons"), infoDict.get("nEgammas"))
+
+def getModelNames(bundles):
+    # the names of the model dirs, made unique if needed
+    names = []
+    for bundle in bundles:
+        name = os.path.basename(os.path.normpath(bundle.model_dir))
+        if name in names: name = name + "_" + str(len(names))
+        names.append(name)
+    return names
+
+def groupByInputSpec(bundles):
+    # dict of input spec -> indices of the bundles using it
+    groups = {}
+    for i, bundle in enumerate(bundles): groups.setdefault(inputSpec(bundle), []).append(i)
+    return groups
+
+def prepareInputs(bundles, groups, data):
+    # builds each distinct (unscaled) input matrix once, returns a dict input spec -> x
+    return {spec:prepareData(bundles[indices[0]], data, scale = False) for spec, indices in groups.items()}
+
+def compareModels(model_dirs, data, batch_size = 10000, foldMode = "ensemble", backend = "keras", verbosity = 0):
+    # Expected input:
+    # - a list of model dirs (or ModelBundles)
+    # - a dataDict from any of the readers
+    #
+    # Expected output:
+    # - a dataframe with the scores of all models (one column per model, named after the model dir;
+    #   models with several outputs get one column per output, <name>_0, <name>_1, ...), with the same event order as the input
+    bundles = [getModelBundle(model_dir, backend = backend, verbosity = verbosity) for model_dir in model_dirs]
+    names = getModelNames(bundles)
+    groups = groupByInputSpec(bundles)
+    if(verbosity > 0): print("Comparing %i models with %i different input formats." % (len(bundles), len(groups)))
+
+    xs = prepareInputs(bundles, groups, data)
+
+    scores = {}
+    for spec, indices in groups.items():
+        for i in indices:
+            y_pred = runBatchedScores(bundles[i], xs[spec], batch_size = batch_size, foldMode = foldMode, verbosity = verbosity)
+            scores[names[i]] = y_pred.reshape(len(y_pred), -1) if y_pred.ndim > 1 else y_pred
+
+    columns = {}
+    for name in names:
+        if scores[name].ndim == 1: columns[name] = scores[name]
+        elif scores[name].shape[1] == 1: columns[name] = scores[name][:,0]
+        else: columns.update({name + "_" + str(j):scores[name][:,j] for j in range(scores[name].shape[1])})
+    return pd.DataFrame(columns)
+
+
+# a sentinel marking the end of the chunks in a queue
+end_of_data = object()
+
+# the stages never block for longer than this (in s) without checking whether they should stop,
+# so that they end when the main thread stops early (exceptions, KeyboardInterrupt)
+poll_interval = 0.1
+
+def putUnlessStopped(output_queue, item, stop):
+    # returns False if the pipeline was stopped before the item could be put into the queue
+    while not stop.is_set():
+        try:
+            output_queue.put(item, timeout = poll_interval)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def getUnlessStopped(input_queue, stop):
+    # returns end_of_data if the pipeline was stopped
+    while not stop.is_set():
+        try:
+            return input_queue.get(timeout = poll_interval)
+        except queue.Empty:
+            continue
+    return end_of_data
+
+def drainQueue(input_queue):
+    # removes everything from a queue, so that the buffered chunks can be freed
+    while True:
+        try:
+            input_queue.get_nowait()
+        except queue.Empty:
+            return
+
+def runStage(function, input_queue, output_queue, stop):
+    # runs function on every item of the input queue and puts the results into the output queue
+    # exceptions are passed on, so that they are raised in the main thread
+    try:
+        for item in iter(lambda: getUnlessStopped(input_queue, stop), end_of_data):
+            if isinstance(item, BaseException):
+                putUnlessStopped(output_queue, item, stop)
+                return
+            if not putUnlessStopped(output_queue, function(item), stop): return
+    except BaseException as exception:
+        putUnlessStopped(output_queue, exception, stop)
+        return
+    putUnlessStopped(output_queue, end_of_data, stop)
+
+def readStage(chunks, output_queue, stop):
+    try:
+        for chunk in chunks:
+            if not putUnlessStopped(output_queue, chunk, stop): return
+    except BaseException as exception:
+        putUnlessStopped(output_queue, exception, stop)
+        return
+    finally:
+        # closing the reader (open files, decompression threads) also if it was stopped early
+        chunks.close()
+    putUnlessStopped(output_queue, end_of_data, stop)
+
+
+class ScoreWriter:
+    # appends the scores and trigger bits of every chunk to resizable datasets in a h5 file
+
+    def __init__(self, filename, thresholds = None, mode = "min", names = None):
+        # names: the names of the models, if multiple models are compared
+        self.h5file = h5py.File(filename, "w")
+        self.thresholds = list(thresholds) if thresholds is not None else []
+        self.mode = mode
+        self.prefixes = [name + "/" for name in names] if names else [""]
+        self.nEvents = 0
+
+    def append(self, name, values):
+        values = np.asarray(values)
+        if name not in self.h5file:
+            self.h5file.create_dataset(name, shape = (0,) + values.shape[1:], maxshape = (None,) + values.shape[1:], dtype = values.dtype, chunks = True)
+        dataset = self.h5file[name]
+        dataset.resize(self.nEvents + len(values), axis = 0)
+        dataset[self.nEvents:] = values
+
+    @instrumentation.instrument("ScoreWriter.write")
+    def write(self, y_preds, total_L1):
+        # y_preds: the scores of each model (in the order of the names)
+        instrumentation.addEvents(len(total_L1))
+        for prefix, y_pred in zip(self.prefixes, y_preds):
+            scores = y_pred[:,0] if y_pred.ndim == 2 and y_pred.shape[1] == 1 else y_pred
+            self.append(prefix + "scores", scores)
+            for threshold in self.thresholds:
+                self.append(prefix + self.mode + "_" + str(threshold).replace(".", "p"), scores > threshold if self.mode == "min" else scores < threshold)
+        self.append("total L1", np.asarray(total_L1, dtype=bool))
+        self.nEvents += len(total_L1)
+
+    def close(self):
+        self.h5file.close()
+
+
+def runPipeline(dataset, model_dir, output_dir, thresholds = None, mode = "min", step_size = 100000, batch_size = 10000,
+                foldMode = "ensemble", backend = "keras", nWorkers = 1, queue_size = 2, totalRate = None, verbosity = 0):
+    # Expected input:
+    # - dataset: dataset spec (dict or json file), see above
+    # - model_dir: model dir or ModelBundle, or a list of them to compare multiple models in a single pass over the data
+    # - output_dir: where the outputs are written
+    # - thresholds / mode: the trigger thresholds for the trigger bits and rates (as in defineTriggerFromThreshold)
+    # - step_size: events per chunk, batch_size: events per inference batch
+    # - foldMode, backend: see inference.runBatchedScores
+    # - nWorkers: threads for the decompression of the input files
+    # - queue_size: maximum number of chunks waiting between two stages
+    #
+    # Expected output:
+    # - the OverlapCounter with all rates (None if no thresholds are given), or a dict model name -> OverlapCounter
+    #   if multiple models are compared. Everything is also written to output_dir
+
+    os.makedirs(output_dir, exist_ok = True)
+    compare = isinstance(model_dir, (list, tuple))
+    model_dirs = list(model_dir) if compare else [model_dir]
+
+    bundles = [getModelBundle(model_dir, backend = backend, verbosity = verbosity) for model_dir in model_dirs]
+    names = getModelNames(bundles)
+    groups = groupByInputSpec(bundles)
+    if(verbosity > 0 and compare): print("Comparing %i models with %i different input formats." % (len(bundles), len(groups)))
+
+    read_queue = queue.Queue(maxsize = queue_size)
+    preprocessed_queue = queue.Queue(maxsize = queue_size)
+
+    def preprocess(chunk):
+        info, data, bits = chunk
+        return info, prepareInputs(bundles, groups, data), bits
+
+    stop = threading.Event()
+    chunks = iterateDataset(dataset, step_size = step_size, nWorkers = nWorkers, verbosity = verbosity)
+    threads = [threading.Thread(target = readStage, args = (chunks, read_queue, stop), daemon = True),
+               threading.Thread(target = runStage, args = (preprocess, read_queue, preprocessed_queue, stop), daemon = True)]
+    for thread in threads: thread.start()
+
+    counters = [OverlapCounter(thresholds, mode = mode) for bundle in bundles] if thresholds is not None else None
+    writer = ScoreWriter(os.path.join(output_dir, "scores.h5"), thresholds, mode = mode, names = names if compare else None)
+
+    # the inference runs in the main thread
+    try:
+        for item in iter(preprocessed_queue.get, end_of_data):
+            if isinstance(item, BaseException): raise item
+            info, xs, bits = item
+
+            y_preds = [runBatchedScores(bundle, xs[inputSpec(bundle)], batch_size = batch_size, foldMode = foldMode, verbosity = verbosity - 1) for bundle in bundles]
+            writer.write(y_preds, bits["total L1"].to_numpy())
+            if counters is not None:
+                for counter, y_pred in zip(counters, y_preds): counter.fill(y_pred, bits)
+
+            if(verbosity > 0): print("Processed %i events." % writer.nEvents)
+    finally:
+        # if the main thread stopped early, the other stages have to stop as well
+        # (they would otherwise wait forever for space in the queues, keeping the input files and chunks alive)
+        stop.set()
+        for thread in threads: thread.join()
+        for pipeline_queue in [read_queue, preprocessed_queue]: drainQueue(pipeline_queue)
+        writer.close()
+
+    if counters is not None:
+        for name, counter in zip(names, counters):
+            suffix = "_" + name if compare else ""
+            counter.summary(totalRate).to_csv(os.path.join(output_dir, "rates" + suffix + ".csv"), index = False)
+            counter.overlapTable(totalRate).to_csv(os.path.join(output_dir, "overlap" + suffix + ".csv"))
+            counter.uniqueTable(totalRate).to_csv(os.path.join(output_dir, "unique" + suffix + ".csv"))
+
+    with open(os.path.join(output_dir, "run_info.json"), "w") as f:
+        json.dump({"dataset": loadDatasetSpec(dataset), "model_dir": [bundle.model_dir for bundle in bundles] if compare else bundles[0].model_dir,
+                   "thresholds": thresholds, "mode": mode, "foldMode": foldMode, "backend": backend, "nEvents": writer.nEvents}, f, indent = 2)
+
+    if(verbosity > 0): print("Done! Outputs written to " + output_dir + ".")
+
+    if counters is None: return None
+    return dict(zip(names, counters)) if compare else counters[0]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Run read -> preprocessing -> inference -> rates as a pipeline over chunks of events.")
+    parser.add_argument("--dataset", help = "json file with the dataset spec")
+    parser.add_argument("--type", help = "dataset type, if no json file is given (L1Ntuple, NanoAOD, anomalyBackground, anomalySignal)")
+    parser.add_argument("--input", help = "input path, if no json file is given")
+    parser.add_argument("--prescale", help = "prescale file, if no json file is given")
+    parser.add_argument("--process", help = "process in anomaly team signal files, if no json file is given")
+    parser.add_argument("--bit-index-from-prescale", action = "store_true", help = "L1 ntuples without uGT aliases: use the bit index of the prescale file, if no json file is given")
+    parser.add_argument("--model-dir", required = True, nargs = "+", help = "one or more model dirs, multiple ones are compared in a single pass")
+    parser.add_argument("--output", required = True)
+    parser.add_argument("--thresholds", type = float, nargs = "*")
+    parser.add_argument("--mode", default = "min", choices = ["min", "max"])
+    parser.add_argument("--step-size", type = int, default = 100000)
+    parser.add_argument("--batch-size", type = int, default = 10000)
+    parser.add_argument("--fold-mode", default = "ensemble")
+    parser.add_argument("--backend", default = "keras", choices = ["keras", "numpy"])
+    parser.add_argument("--workers", type = int, default = os.cpu_count())
+    parser.add_argument("--queue-size", type = int, default = 2)
+    parser.add_argument("--profile", help = "record the time, events, bytes and memory of every stage, and store the trace in this json file")
+    parser.add_argument("--trace-memory", action = "store_true", help = "with --profile: measure the memory peak of every stage with tracemalloc (slow)")
+    parser.add_argument("-v", "--verbosity", type = int, default = 1)
+    args = parser.parse_args()
+
+    if args.dataset: dataset = args.dataset
+    elif args.type and args.input:
+        dataset = {"type": args.type, "path": args.input}
+        if args.prescale: dataset["prescale"] = args.prescale
+        if args.process: dataset["process"] = args.process
+        if args.bit_index_from_prescale: dataset["bitIndexFromPrescale"] = True
+    else:
+        parser.error("either --dataset or --type and --input are needed")
+
+    foldMode = int(args.fold_mode) if args.fold_mode.isdigit() else args.fold_mode
+
+    model_dir = args.model_dir if len(args.model_dir) > 1 else args.model_dir[0]
+
+    if args.profile: instrumentation.enable(traceMemory = args.trace_memory)
+
+    runPipeline(dataset, model_dir, args.output, thresholds = args.thresholds, mode = args.mode, step_size = args.step_size,
+                batch_size = args.batch_size, foldMode = foldMode, backend = args.backend, nWorkers = args.workers,
+                queue_size = args.queue_size, verbosity = args.verbosity)
+
+    if args.profile:
+        instrumentation.printSummary()
+        instrumentation.saveTrace(args.profile)
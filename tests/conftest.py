@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules in src are imported directly (as in the notebooks and the benchmarks)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from inference import OverlapCounter
+
+
+def bruteForceCounts(y_pred, bit_matrix, total_L1, thresholds, mode):
+    # the counts of OverlapCounter, threshold by threshold
+    counts = {"nPass": [], "nPure": [], "nOverlap": [], "nUnique": []}
+    only_one = bit_matrix.sum(axis = 1) == 1
+    for threshold in thresholds:
+        passed = y_pred > threshold if mode == "min" else y_pred < threshold
+        counts["nPass"].append(passed.sum())
+        counts["nPure"].append((passed & ~total_L1).sum())
+        counts["nOverlap"].append((passed[:,None] & bit_matrix).sum(axis = 0))
+        counts["nUnique"].append((passed[:,None] & only_one[:,None] & bit_matrix).sum(axis = 0))
+    return {key:np.array(value) for key, value in counts.items()}
+
+
+def randomInputs(nEvents = 2000, nSeeds = 11, seed = 6):
+    rng = np.random.default_rng(seed)
+    # rounded scores, so that some of them are exactly on a threshold
+    y_pred = np.round(rng.random(nEvents), 2)
+    bit_matrix = rng.random((nEvents, nSeeds)) < 0.15
+    total_L1 = bit_matrix.any(axis = 1) | (rng.random(nEvents) < 0.1)
+    thresholds = rng.permutation(np.linspace(0.05, 0.95, 19))
+    return y_pred, bit_matrix, total_L1, thresholds
+
+
+@pytest.mark.parametrize("mode", ["min", "max"])
+def test_counts_match_brute_force(mode):
+    y_pred, bit_matrix, total_L1, thresholds = randomInputs()
+    seeds = ["L1_seed" + str(i) for i in range(bit_matrix.shape[1])]
+    bits = pd.DataFrame(bit_matrix, columns = seeds)
+    bits.insert(0, "total L1", total_L1)
+
+    # filled in two chunks and merged, as in the runner
+    counter = OverlapCounter(thresholds, mode = mode).fill(y_pred[:700], bits[:700]) + OverlapCounter(thresholds, mode = mode).fill(y_pred[700:], bits[700:])
+    expected = bruteForceCounts(y_pred, bit_matrix, total_L1, counter.thresholds, mode)
+
+    assert counter.nEvents == len(y_pred)
+    assert counter.seeds == seeds
+    for key, value in expected.items():
+        np.testing.assert_array_equal(getattr(counter, key), value, err_msg = key)
+    np.testing.assert_array_equal(counter.nSeed, bit_matrix.sum(axis = 0))
+
+
+@pytest.mark.parametrize("mode", ["min", "max"])
+def test_packed_bits_match_brute_force(mode):
+    # without a dataframe, the total L1 bit is the OR of the seeds
+    y_pred, bit_matrix, total_L1, thresholds = randomInputs()
+    seeds = ["L1_seed" + str(i) for i in range(bit_matrix.shape[1])]
+
+    counter = OverlapCounter(thresholds, seeds = seeds, mode = mode).fill(y_pred, np.packbits(bit_matrix, axis = 1), packed = True)
+    expected = bruteForceCounts(y_pred, bit_matrix, bit_matrix.any(axis = 1), counter.thresholds, mode)
+
+    for key, value in expected.items():
+        np.testing.assert_array_equal(getattr(counter, key), value, err_msg = key)
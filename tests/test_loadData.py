@@ -0,0 +1,76 @@
+import numpy as np
+import awkward as ak
+import uproot
+import pytest
+
+from loadData import readFromNanoAOD, iterateNanoAOD
+
+
+def writeNanoAOD(filepath, nEvents, seed):
+    # a minimal NanoAOD Events tree: the L1 objects as jagged branches (nL1Mu, L1Mu_pt, ...) and a few L1 bits
+    rng = np.random.default_rng(seed)
+    branches = {}
+    for prefix, maxN in [("L1Mu", 3), ("L1EG", 4), ("L1Jet", 6)]:
+        counts = rng.integers(0, maxN + 1, nEvents)
+        nObjects = counts.sum()
+        branches[prefix] = ak.zip({"pt": ak.unflatten(rng.exponential(20, nObjects).astype(np.float32), counts),
+                                   "eta": ak.unflatten(rng.normal(0, 2, nObjects).astype(np.float32), counts),
+                                   "phi": ak.unflatten(rng.uniform(-np.pi, np.pi, nObjects).astype(np.float32), counts)})
+    counts = np.full(nEvents, 2)
+    branches["L1EtSum"] = ak.zip({"pt": ak.unflatten(rng.exponential(30, 2 * nEvents).astype(np.float32), counts),
+                                  "phi": ak.unflatten(rng.uniform(-np.pi, np.pi, 2 * nEvents).astype(np.float32), counts),
+                                  "etSumType": ak.unflatten(np.tile(np.array([0, 2], dtype=np.int32), nEvents), counts)})
+    for seed_name in ["L1_SingleMu22", "L1_DoubleEG8", "L1_ZeroBias"]:
+        branches[seed_name] = rng.random(nEvents) < 0.2
+
+    # mktree and extend name the branches as in NanoAOD (nL1Mu, L1Mu_pt, ...)
+    with uproot.recreate(filepath) as f:
+        f.mktree("Events", {name:branch.type.content if isinstance(branch, ak.Array) else branch.dtype for name, branch in branches.items()})
+        f["Events"].extend(branches)
+    return branches
+
+
+@pytest.fixture
+def nanoAOD(tmp_path):
+    inputs = [writeNanoAOD(str(tmp_path / ("nano_%i.root" % i)), nEvents, seed = i) for i, nEvents in enumerate([120, 80])]
+
+    # only L1_SingleMu22 and L1_ZeroBias are un-prescaled (fifth column)
+    prescale_file = tmp_path / "prescales.csv"
+    prescale_file.write_text("Index,Name,Emergency,2.2E+34,2E+34,1.7E+34\n0,L1_ZeroBias,0,1,1,1\n1,L1_SingleMu22,0,1,1,1\n2,L1_DoubleEG8,0,10,10,10\n")
+
+    return str(tmp_path), str(prescale_file), inputs
+
+
+def test_readFromNanoAOD(nanoAOD):
+    inputpath, prescale_file, inputs = nanoAOD
+    infoDict, dataDict, bits = readFromNanoAOD(inputpath, prescale_file)
+
+    assert infoDict["nFiles"] == 2
+    assert infoDict["nEvents"] == 200
+    for collection, prefix in [("muons", "L1Mu"), ("egammas", "L1EG"), ("jets", "L1Jet")]:
+        expected = ak.concatenate([branches[prefix] for branches in inputs])
+        for field in ["pt", "eta", "phi"]:
+            assert ak.all(dataDict[collection][field] == expected[field])
+    energysums = ak.concatenate([branches["L1EtSum"] for branches in inputs])
+    assert ak.all(dataDict["energysums"].Type == energysums.etSumType)
+
+    # only the un-prescaled seeds, the total L1 bit is their OR
+    assert list(bits.columns) == ["total L1", "L1_SingleMu22", "L1_ZeroBias"]
+    seeds = np.stack([np.concatenate([branches[seed] for branches in inputs]) for seed in ["L1_SingleMu22", "L1_ZeroBias"]], axis = 1)
+    np.testing.assert_array_equal(bits[["L1_SingleMu22", "L1_ZeroBias"]].to_numpy(), seeds)
+    np.testing.assert_array_equal(bits["total L1"].to_numpy(), seeds.any(axis = 1))
+
+
+def test_iterateNanoAOD_matches_readFromNanoAOD(nanoAOD):
+    inputpath, prescale_file, inputs = nanoAOD
+    infoDict, dataDict, bits = readFromNanoAOD(inputpath)
+
+    chunks = list(iterateNanoAOD(inputpath, step_size = 50, moreInfo = {"name": "test"}))
+    assert [info["nEvents"] for info, data, chunk_bits in chunks] == [50, 50, 20, 50, 30]
+    assert [info["chunk"] for info, data, chunk_bits in chunks] == list(range(5))
+    assert all(info["name"] == "test" for info, data, chunk_bits in chunks)
+
+    # all L1_* bits without a prescale file
+    assert list(bits.columns) == ["total L1", "L1_SingleMu22", "L1_DoubleEG8", "L1_ZeroBias"]
+    assert ak.all(ak.concatenate([data["jets"].pt for info, data, chunk_bits in chunks]) == dataDict["jets"].pt)
+    np.testing.assert_array_equal(np.concatenate([chunk_bits.to_numpy() for info, data, chunk_bits in chunks]), bits.to_numpy())
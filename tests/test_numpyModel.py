@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from numpyModel import loadNumpyModel, exportDenseWeights, activations
+
+
+@pytest.fixture
+def kerasModel(tmp_path):
+    # a tiny dense model with all layer types of our networks, with non-trivial batch normalization statistics
+    keras = pytest.importorskip("keras")
+    keras.utils.set_random_seed(7)
+    model = keras.Sequential([keras.Input((8,)),
+                              keras.layers.Dense(16, activation = "relu"),
+                              keras.layers.BatchNormalization(),
+                              keras.layers.Dropout(0.2),
+                              keras.layers.Dense(8, activation = "tanh"),
+                              keras.layers.Dense(1, activation = "sigmoid")])
+
+    batchnorm = model.layers[1]
+    gamma, beta, mean, variance = batchnorm.get_weights()
+    rng = np.random.default_rng(7)
+    batchnorm.set_weights([gamma * 1.5, beta + 0.1, mean + rng.normal(0, 0.5, mean.shape), variance + rng.uniform(0.1, 1, variance.shape)])
+
+    model_file = str(tmp_path / "model_fold0.h5")
+    model.save(model_file)
+    return model, model_file
+
+
+def test_numpy_backend_matches_keras(kerasModel):
+    model, model_file = kerasModel
+    x = np.random.default_rng(8).normal(0, 1, (1000, 8)).astype(np.float32)
+
+    y_keras = model.predict(x, verbose = 0)
+    y_numpy = loadNumpyModel(model_file).predict(x, batch_size = 300)
+
+    assert y_numpy.shape == y_keras.shape
+    np.testing.assert_allclose(y_numpy, y_keras, rtol = 1e-5, atol = 1e-6)
+
+
+def test_exported_weights_match_keras(kerasModel, tmp_path):
+    model, model_file = kerasModel
+    x = np.random.default_rng(9).normal(0, 1, (1000, 8)).astype(np.float32)
+
+    npz_file = str(tmp_path / "model_fold0.npz")
+    exportDenseWeights(model_file, npz_file)
+
+    np.testing.assert_allclose(loadNumpyModel(npz_file).predict(x), model.predict(x, verbose = 0), rtol = 1e-5, atol = 1e-6)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("name", ["sigmoid", "swish", "silu"])
+def test_sigmoid_activations_saturate_without_overflow(name, dtype):
+    x = np.array([-1e4, -100, -10, -1, 0, 1, 10, 100, 1e4], dtype=dtype)
+    with np.errstate(over = "raise", invalid = "raise", divide = "raise"):
+        y = activations[name](x)
+
+    # the sigmoid via tanh as reference, it is bounded everywhere
+    sigmoid = 0.5 * (1 + np.tanh(x.astype(np.float64) / 2))
+    expected = sigmoid if name == "sigmoid" else x * sigmoid
+    assert y.dtype == dtype
+    np.testing.assert_allclose(y, expected, rtol = 1e-6, atol = 1e-30)
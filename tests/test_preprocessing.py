@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from loadData import anomalyCubeToAwkward, anomalyCubeToDense
+from preprocessing import formatDataTopotrigger, formatDenseTopotrigger
+
+
+def randomCube(nEvents = 500, seed = 5):
+    # a (N,19,3) data cube with empty objects (pt = 0) at random positions, not only at the end
+    rng = np.random.default_rng(seed)
+    cube = np.stack( (rng.exponential(20, (nEvents, 19)),
+                      rng.normal(0, 2, (nEvents, 19)),
+                      rng.uniform(-np.pi, np.pi, (nEvents, 19))), axis=2 )
+    cube[rng.random((nEvents, 19)) < 0.3] = 0
+    cube[:,0,0] = rng.exponential(30, nEvents)
+    cube[:,0,1] = 0
+    return cube
+
+
+@pytest.mark.parametrize("infoDict", [
+    {"nJets": 10, "nMuons": 4, "nEgammas": 4},
+    {"nJets": 4, "nMuons": 2, "nEgammas": 2},
+    {"nJets": 12, "nMuons": 6, "nEgammas": 1},
+])
+def test_dense_topo_inputs_match_awkward_path(infoDict):
+    cube = randomCube()
+    awkward_data = {collection:anomalyCubeToAwkward(cube, collection) for collection in ["muons", "egammas", "jets", "energysums"]}
+
+    x_awkward = formatDataTopotrigger(infoDict, awkward_data)
+    x_dense = formatDenseTopotrigger(infoDict, anomalyCubeToDense(cube))
+
+    assert x_dense.shape == x_awkward.shape
+    np.testing.assert_array_equal(x_dense, x_awkward)